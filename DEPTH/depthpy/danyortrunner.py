@@ -19,6 +19,7 @@ sys.path.append(os.path.join(
 	"dany/"
 ))
 from dany.depth_anything.util.transform import Resize, NormalizeImage, PrepareForNet
+from midas.transforms import ToFloatImage
 
 class DanyOrtRunner(Runner):
 	def framework_init(self):
@@ -47,6 +48,7 @@ class DanyOrtRunner(Runner):
 		self.net_w, self.net_h = 518, 518
 
 		self.transform = Compose([
+			ToFloatImage(), #before the cubic resize, whose overshoot would be clamped in uint8
 			Resize(
 				width=self.net_w,
 				height=self.net_h,
@@ -56,7 +58,7 @@ class DanyOrtRunner(Runner):
 				resize_method='lower_bound',
 				image_interpolation_method=cv2.INTER_CUBIC,
 			),
-			NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+			NormalizeImage(mean=np.array([0.485, 0.456, 0.406], dtype=np.float32), std=np.array([0.229, 0.224, 0.225], dtype=np.float32)), #float32, not to promote the image to float64
 			PrepareForNet(),
 		])
 
@@ -10,6 +10,7 @@ A modification of
 from depth import Runner
 
 import cv2
+import numpy as np
 import torch
 from torchvision.transforms import Compose
 
@@ -21,6 +22,7 @@ sys.path.append(os.path.join(
 ))
 from dany.depth_anything.dpt import DepthAnything
 from dany.depth_anything.util.transform import Resize, NormalizeImage, PrepareForNet
+from midas.transforms import ToFloatImage
 
 class DanyRunner(Runner):
 	def framework_init(self):
@@ -56,6 +58,7 @@ class DanyRunner(Runner):
 		self.net_w, self.net_h = 518, 518
 
 		self.transform = Compose([
+			ToFloatImage(), #before the cubic resize, whose overshoot would be clamped in uint8
 			Resize(
 				width=self.net_w,
 				height=self.net_h,
@@ -65,7 +68,7 @@ class DanyRunner(Runner):
 				resize_method='lower_bound',
 				image_interpolation_method=cv2.INTER_CUBIC,
 			),
-			NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+			NormalizeImage(mean=np.array([0.485, 0.456, 0.406], dtype=np.float32), std=np.array([0.229, 0.224, 0.225], dtype=np.float32)), #float32, not to promote the image to float64
 			PrepareForNet(),
 		])
 
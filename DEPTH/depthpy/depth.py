@@ -13,6 +13,11 @@ import time
 import hashlib
 import traceback
 import sys
+import threading
+import queue
+import itertools
+import multiprocessing
+import glob
 from typing import Union, Iterable, Tuple
 
 import numpy as np
@@ -20,9 +25,119 @@ import cv2
 import torch
 
 from midas.model_loader import default_models, load_model
+from midas.transforms import PrepareBatchForNet, PrepareBatchOnDevice
+from midas.backbones.beit import set_sdpa, set_rel_pos_bias_cache, REL_POS_BIAS_CACHE_MIB
+from depthfile import ParallelZipWriter, StreamingTarget, get_checkpoint, set_checkpoint, get_last_contiguous, DeltaEncoder, DepthVideoWriter, RawDepthWriter, merge_depthfiles, is_complete, read_metadata
 
 VERSION = "v0.10.0-beta.2"
 
+#Same as the viewer's
+IMAGE_EXTS = [".jpg", ".jpeg", ".png"]
+VIDEO_EXTS = [".mp4", ".asf", ".avi", ".dv", ".m4v", ".mov", ".mpg", ".mpeg", ".ogv", ".vp8", ".webm", ".wmv", ".mkv"]
+
+def get_sha256(path) -> str:
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as fin:
+		while True:
+			datablock = fin.read(128*1024) #buffer it
+			if not datablock:
+				break
+			sha256.update(datablock)
+	return sha256.hexdigest()
+
+def get_fingerprint(path, samples=16, blocksize=64*1024) -> str:
+	"""
+	A fast content fingerprint: SHA-256 of the file size & `samples` blocks at evenly spaced offsets (including the first & the last ones).
+	It reads at most `samples * blocksize` bytes whatever the size, but unlike `get_sha256()`, changes outside the sampled blocks are not detected.
+	"""
+
+	size = os.path.getsize(path)
+	sha256 = hashlib.sha256()
+	sha256.update(f"{size}:{samples}:{blocksize}\n".encode("ascii"))
+
+	with open(path, "rb") as fin:
+		if size <= samples * blocksize:
+			sha256.update(fin.read())
+		else:
+			for k in range(samples):
+				fin.seek((size - blocksize) * k // (samples - 1))
+				sha256.update(fin.read(blocksize))
+
+	return sha256.hexdigest()
+
+def get_sha256_async(path):
+	"""
+	Compute `get_sha256(path)` on a background thread, so that it overlaps with the inference.
+	Returns a function that waits for the result (and rethrows the exception, if any).
+	"""
+
+	result = {}
+	def work():
+		try:
+			result["hashval"] = get_sha256(path)
+		except Exception as exc:
+			result["exc"] = exc
+
+	thread = threading.Thread(target=work, daemon=True)
+	thread.start()
+
+	def wait():
+		thread.join()
+		if "exc" in result:
+			raise result["exc"]
+		return result["hashval"]
+
+	return wait
+
+def prefetch(iterable, maxsize=4):
+	"""
+	Iterate `iterable` on a background thread, handing the items over through a bounded queue.
+	Exceptions raised by the producer are rethrown on the consumer side.
+	Closing the returned generator stops the producer.
+	"""
+
+	q = queue.Queue(maxsize=maxsize)
+	stop = threading.Event()
+	end = object() #sentinel
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				q.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def produce():
+		it = iter(iterable)
+		try:
+			for item in it:
+				if not put((item, None)):
+					break
+			else:
+				put((end, None))
+		except BaseException as exc:
+			put((end, exc))
+		finally:
+			if hasattr(it, "close"):
+				it.close()
+
+	thread = threading.Thread(target=produce, daemon=True)
+	thread.start()
+
+	try:
+		while True:
+			item, exc = q.get()
+			if exc is not None:
+				raise exc
+			if item is end:
+				break
+			yield item
+	finally:
+		stop.set()
+		thread.join()
+
 class ModelParams():
 	#this might as well just be a dictionary rather than a class
 
@@ -61,10 +176,25 @@ class Runner():
 		#Should be identical to `run_frames([img])[1][0]`
 		raise NotImplementedError()
 	
-	def run_frames(self, imgs: Iterable, batch_size) -> Tuple[int, np.ndarray]:
+	def run_frames(self, imgs: Iterable, batch_size, pad_to=None) -> Tuple[int, np.ndarray]:
 		#Returns:
 		# 	# of valid frames, the frames
+		#With `pad_to` (width, height), the images of different sizes are padded to it and the outputs are cropped back (a list)
 		raise NotImplementedError()
+
+	#`run_frame()` & `run_frames()` split into the preprocessing and the rest, so that `run()` can preprocess on its own thread.
+	#By default nothing is split out; the runners override them where the preprocessing is worth it
+	def prepare_frame(self, img):
+		return img
+
+	def run_prepared_frame(self, prepared) -> np.ndarray:
+		return self.run_frame(prepared)
+
+	def prepare_frames(self, imgs: Iterable, batch_size, pad_to=None):
+		return list(itertools.islice(imgs, batch_size))
+
+	def run_prepared_frames(self, prepared, batch_size, pad_to=None) -> Tuple[int, np.ndarray]:
+		return self.run_frames(prepared, batch_size, pad_to=pad_to)
 	
 	def __init__(self):
 		print("Initialize")
@@ -81,6 +211,9 @@ class Runner():
 		self.net_w = None
 		self.net_h = None
 
+		#With `stride`, frames farther than this are sought rather than grabbed (seeking decodes from the preceding keyframe)
+		self.min_seek_distance = 30
+
 	def model_exists(self, model_type) -> Union[str, None]:
 		orig_cwd = os.getcwd()
 		os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -99,7 +232,7 @@ class Runner():
 		os.chdir(orig_cwd)
 		return model_path
 
-	def run(self, inpath, outpath, isimage, zip_in_memory=True, update=True, batch_size=None, frameformat="pgm") -> None:
+	def run(self, inpath, outpath, isimage, zip_in_memory=True, update=True, batch_size=None, frameformat="pgm", pipeline=False, zip_workers=None, zip_streaming=False, resume=False, keyframe_interval=30, container="zip", start=0, end=None, stride=1, hashval=None, fingerprint=None, computed=None) -> int:
 		"""Run MonoDepthNN to compute depth maps.
 
 		Args:
@@ -107,7 +240,23 @@ class Runner():
 			outpath (str): output directory.
 			isvideo (bool): whether the input is a video.
 			zip_in_memory (bool): If True, ZIP file will be created in the RAM until it finishes writing.
+			zip_streaming (bool): If True, ZIP file will be created as a temporary file on the disk and renamed when it finishes writing. Overrides `zip_in_memory`.
 			batch_size (int | None): If valid integer, it will use `self.run_frames()`. Else, it will use `self.run_frame()`.
+			pipeline (bool): If True, decoding, inference, encoding and writing run concurrently on separate threads.
+			zip_workers (int | None): If valid integer, the frame files are compressed in a pool of this many threads.
+			resume (bool): If True (and `update`), the video is sought to the frame after the checkpoint recorded in the archive.
+			keyframe_interval (int): For the delta frame formats, the max. distance between keyframes.
+			container (str): `zip` for the depthfile, `ffv1` for a lossless grayscale video (8-bit, or 16-bit for the `pgm16` formats) with `<outpath>.METADATA.txt`,
+				or `raw` for a memory-mappable array file (uint8, uint16 for the `pgm16` formats, or float16 for `pfm`).
+			start (int): (Video) the index of the first frame to process.
+			end (int | None): (Video) the index to stop before. None for the end of the video.
+			stride (int): (Video) process every `stride`th frame from `start`. The frame files keep the indices of the video.
+			hashval (str | None): SHA-256 of the input for the metadata, if it is already known.
+			fingerprint (str | None): `get_fingerprint()` of the input, to be stored in the metadata along with `hashval`.
+			computed (tuple | None): (Image) (input image, depth map) already computed by the caller, e.g. `run_batch()` batching the images. Reading & inference are skipped.
+
+		Returns:
+			int: the number of frames written
 		"""
 
 		print(f"Source: {inpath}")
@@ -117,104 +266,282 @@ class Runner():
 			print(f"ERROR: Could not find {inpath}")
 			return
 
-		#Get the generator
+		#The frame range (before the output is opened, so that an invalid one leaves it as it is)
 		if isimage:
-			inputs = self.read_image(inpath)
-		else:
-			inputs = self.read_video(inpath)
-
-		#Prepare the zipfile
-		if zip_in_memory:
-			if update and os.path.exists(outpath):
-				with open(outpath, "rb") as fin:
-					mem_buffer = io.BytesIO(fin.read())
+			start, end, stride = 0, None, 1
+		elif start < 0 or stride < 1 or (end is not None and end <= start):
+			print(f"ERROR: Invalid range: start={start}, end={end}, stride={stride}")
+			return
+		frame_range = (start, end, stride) if (start, end, stride) != (0, None, 1) else None
+
+		#Prepare the output
+		streaming = None
+		framewriter = None #For the containers other than zip
+		if container in ["ffv1", "raw"]:
+			if update:
+				print(f"The {container} container is always written from the start. Ignoring `update`.")
+				update = False
+			zip_in_memory = False
+
+			if container == "ffv1":
+				bits = 16 if frameformat in ["pgm16", "pgm16delta"] else 8
+				print(f"Writing a {bits}-bit FFV1 video.")
+				framewriter = DepthVideoWriter(outpath, bits=bits)
 			else:
-				mem_buffer = io.BytesIO()
+				dtype = {"pgm16": np.uint16, "pgm16delta": np.uint16, "pfm": np.float16}.get(frameformat, np.uint8)
+				print(f"Writing a raw {np.dtype(dtype).name} array file.")
+				framewriter = RawDepthWriter(outpath, dtype=dtype, start=start, stride=stride)
+			zout = framewriter #for `save_metadata()`
 		else:
-			mem_buffer = outpath
+			#Prepare the zipfile
+			if zip_streaming:
+				if zip_in_memory:
+					print("Ignoring `zip_in_memory` since `zip_streaming` is set.")
+					zip_in_memory = False
+
+				streaming = StreamingTarget(outpath, update=update, resume=resume)
+				mem_buffer = streaming.path
+			elif zip_in_memory:
+				if update and os.path.exists(outpath):
+					with open(outpath, "rb") as fin:
+						mem_buffer = io.BytesIO(fin.read())
+				else:
+					mem_buffer = io.BytesIO()
+			else:
+				mem_buffer = outpath
+
+			zipfilemode = "a" if update else "w"
+			compresslevel = 5
+			zout = zipfile.ZipFile(mem_buffer, zipfilemode, compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
 
-		zipfilemode = "a" if update else "w"
-		zout = zipfile.ZipFile(mem_buffer, zipfilemode, compression=zipfile.ZIP_DEFLATED, compresslevel=5)
 		if update:
 			existing_filelist = zout.namelist()
 			has_metadata = "METADATA.txt" in existing_filelist
 		else:
 			has_metadata = False
-		
-		has_written_metadata = False
-		frames_dict = {} #{pgmname: frame}, for batch inference
-		prev = time.time()
-		starttime = prev
-		
-		for i, img in enumerate(inputs):
-			#Save width, height & the original size
-			#Write the metadata
-			if not has_written_metadata and not has_metadata:
-				original_shape = img.shape[:2]
-
-				#Pass dummy data for the metadata. The first input may takes some time.
-				print("Passing a dummy data. This may take a second.")
-				dummy = np.zeros_like(img)
-				if batch_size is None:
-					dummy = self.run_frame(img)
+
+		#Find where to resume from
+		startframe = start
+		start_msec = None
+		if resume and not isimage:
+			if not update:
+				print("Ignoring `resume` since `update` is not set.")
+			else:
+				checkpoint = get_checkpoint(zout)
+				lastframe = checkpoint["lastframe"] if checkpoint is not None else -1
+				if lastframe >= start and (lastframe - start) % stride == 0 and f"{lastframe}.{frameformat}" in existing_filelist:
+					print(f"Found the checkpoint: {checkpoint}")
+					startframe = lastframe + stride
+					start_msec = checkpoint["pos_msec"]
+				else:
+					#No (valid) checkpoint: use the existing frames
+					startframe = get_last_contiguous(existing_filelist, frameformat, start=start, stride=stride) + stride
+				print(f"Resuming from #{startframe}")
+
+		#Get the generator
+		if isimage:
+			self.framecount, self.framerate = 1, 0 #May be left from a previous video (`run_batch()`)
+			inputs = [computed[0]] if computed is not None else self.read_image(inpath)
+		else:
+			inputs = self.read_video(inpath, startframe=startframe, start_msec=start_msec, endframe=end, stride=stride)
+
+		#The hash for the metadata is computed in the background, and the metadata is written at the end
+		if not has_metadata:
+			get_hashval = (lambda: hashval) if hashval is not None else get_sha256_async(inpath)
+		metadata_shapes = None #(shape, original_shape), set by `infer_stage()`
+
+		first_img = None #for the metadata
+		starttime = time.time()
+
+		def prepare(frames):
+			#Yields (indices, prepared input) for the frames to infer: one frame (`prepare_frame()`),
+			#or with `batch_size`, a batch (`prepare_frames()`)
+			nonlocal first_img
+
+			frames_dict = {} #{i: frame}, for batch inference
+
+			for i, img in frames:
+				if first_img is None:
+					first_img = img
+
+				print("! On #{}".format(i)) #starts with 0
+
+				pgmname = f"{i}.{frameformat}"
+				if update and pgmname in existing_filelist:
+					print("Already exists.")
+					continue
+
+				if computed is not None:
+					yield [i], None
+
+				#Using `run_frame()`
+				elif batch_size is None:
+					yield [i], self.prepare_frame(img)
+
+				#Using `run_frames()` (Batch inference)
 				else:
-					_, dummy = self.run_frames([dummy], batch_size=batch_size)
-					dummy = dummy[0] #Get the first one
-				shape = dummy.shape
+					frames_dict[i] = img
+					if len(frames_dict) >= batch_size:
+						yield list(frames_dict.keys()), self.prepare_frames(frames_dict.values(), batch_size=batch_size)
+						frames_dict = {} #Reset.
+
+			#(Batch inference): The remaining ones
+			if batch_size is not None and frames_dict != {}:
+				yield list(frames_dict.keys()), self.prepare_frames(frames_dict.values(), batch_size=batch_size)
+
+		def infer(prepared):
+			#Yields (i, out_ndarray) in input order
+			prev = time.time()
+
+			for indices, inputs in prepared:
+				if computed is not None:
+					yield indices[0], computed[1]
 				
-				self.save_metadata(zout=zout, inpath=inpath, shape=shape, original_shape=original_shape)
-				has_written_metadata = True
+				#Using `run_frame()`
+				elif batch_size is None: 
+					yield indices[0], self.run_prepared_frame(inputs)
 
-			print("! On #{}".format(i)) #starts with 0
+					now = time.time()
+					print(f"Processed, fps: {1 / (now - prev) :.2f}")
+					prev = now
 
-			pgmname = f"{i}.{frameformat}"
-			if update and pgmname in existing_filelist:
-				print("Already exists.")
-				continue
-			
-			#Using `run_frame()`
-			if batch_size is None: 
-				out_ndarray = self.run_frame(img)
-				pgm = self.get_framefile(out_ndarray, frameformat)
-				zout.writestr(pgmname, pgm)
-
-				now = time.time()
-				fps_per_inf = 1 / (now - prev)
-				print(f"Processed, fps: {1 / (now - prev) :.2f}")
-				prev = now
-
-			#Using `run_frames()` (Batch inference)
-			else:
-				##
-				def process_frames_dict(frames_dict):
-					#Process
-					print(f"Processing: {list(frames_dict.keys())}")
-
-					_, out_ndarrays = self.run_frames(frames_dict.values(), batch_size=batch_size)
-					for pgmname, out_ndarray in zip(frames_dict.keys(), out_ndarrays):
-						pgm = self.get_framefile(out_ndarray, frameformat)
-						zout.writestr(pgmname, pgm)
-				##
-
-				frames_dict[pgmname] = img
-				if len(frames_dict) >= batch_size:
-					shape = process_frames_dict(frames_dict)
-					frames_dict = {} #Reset.
+				#Using `run_frames()` (Batch inference)
+				else:
+					print(f"Processing: {[f'{i}.{frameformat}' for i in indices]}")
+
+					_, out_ndarrays = self.run_prepared_frames(inputs, batch_size=batch_size)
+					yield from zip(indices, out_ndarrays)
 
 					now = time.time()
 					fps_per_inf = 1 / (now - prev)
 					print(f"Processed, fps: {fps_per_inf :.2f} * {batch_size} == {fps_per_inf * batch_size :.2f}")
 					prev = now
 
-		#(Batch inference): Process the remaining ones
-		if batch_size is not None and frames_dict != {}: 
-			shape = process_frames_dict(frames_dict)
+		def infer_stage(prepared):
+			#`infer()`, taking the size for the metadata (width, height & the original size) from the first output,
+			#so that no extra inference is needed for it
+			nonlocal metadata_shapes
 
-		print(f"Took {time.time() - starttime :.2f}s")
+			for i, out_ndarray in infer(prepared):
+				if metadata_shapes is None and not has_metadata:
+					metadata_shapes = (out_ndarray.shape[:2], first_img.shape[:2])
 
-		#ZipFile Close
-		zout.close()
-		
+				yield i, out_ndarray
+
+			#Every frame already existed, but the metadata did not
+			if metadata_shapes is None and not has_metadata and first_img is not None:
+				print("Passing the first frame for the metadata. This may take a second.")
+				metadata_shapes = (self.run_frame(first_img).shape[:2], first_img.shape[:2])
+
+		def encode_stage(outputs):
+			if framewriter is not None:
+				#The arrays themselves: quantized, or as float16
+				dtype = framewriter.dtype
+				if dtype.kind == 'f':
+					encode = lambda i, image: image.astype(dtype)
+				else:
+					encode = lambda i, image: self.quantize(image, np.empty(image.shape[:2], dtype=dtype))
+			else:
+				encode = self.get_frame_encoder(frameformat, keyframe_interval=keyframe_interval)
+
+			for i, out_ndarray in outputs:
+				yield i, encode(i, out_ndarray)
+
+		#Decode -> prepare (the transform) -> infer -> encode -> write
+		#When pipelined, each stage runs on its own thread and the stages are connected by bounded queues,
+		#so the total speed is that of the slowest stage rather than the sum of them.
+		if pipeline:
+			print("Using the pipelined mode.")
+			queue_size = max(4, 2 * batch_size) if batch_size is not None else 4
+			frames = prefetch(zip(itertools.count(startframe, stride), inputs), maxsize=queue_size)
+			prepared = prefetch(prepare(frames), maxsize=4 if batch_size is None else 2) #whole batches
+			outputs = prefetch(infer_stage(prepared), maxsize=queue_size)
+			framefiles = prefetch(encode_stage(outputs), maxsize=queue_size)
+			stages = [framefiles, outputs, prepared, frames] #closed in this order, each after the thread consuming it has stopped
+		else:
+			framefiles = encode_stage(infer_stage(prepare(zip(itertools.count(startframe, stride), inputs))))
+			stages = [framefiles]
+
+		if zip_workers is not None and zip_workers > 0 and framewriter is None:
+			print(f"Compressing with {zip_workers} workers.")
+			writer = ParallelZipWriter(zout, workers=zip_workers, compresslevel=compresslevel)
+		else:
+			writer = None
+
+		written = 0
+		completed = False
+		try:
+			for i, framefile in framefiles:
+				written += 1
+				if framewriter is not None:
+					framewriter.write(i, framefile, framerate=self.framerate)
+					continue
+
+				pgmname = f"{i}.{frameformat}"
+				if writer is not None:
+					writer.writestr(pgmname, framefile)
+				else:
+					zout.writestr(pgmname, framefile)
+
+				if streaming is not None:
+					streaming.written(zout)
+
+			completed = True
+		finally:
+			#Stops the producer threads, if any. Closing a stage does not close the ones it consumes
+			for stage in stages:
+				stage.close()
+			if writer is not None:
+				writer.close()
+
+			print(f"Took {time.time() - starttime :.2f}s")
+
+			#The metadata, once the hash is done. This is also done when interrupted, so that the file can be opened.
+			#If this fails (e.g. the input is gone), the archive is still closed below, but not committed;
+			#the error is rethrown after it unless another one is already propagating.
+			metadata_exc = None
+			if metadata_shapes is not None:
+				try:
+					shape, original_shape = metadata_shapes
+					self.save_metadata(zout=zout, inpath=inpath, shape=shape, original_shape=original_shape, frame_range=frame_range, hashval=get_hashval(), fingerprint=fingerprint)
+				except Exception as exc:
+					traceback.print_exc()
+					print("ERROR: Could not save the metadata.")
+					metadata_exc = exc
+					completed = False
+
+			try:
+				#Record the checkpoint. This is also done when interrupted, so that it can be resumed.
+				if not isimage and framewriter is None:
+					lastframe = get_last_contiguous(zout.namelist(), frameformat, start=start, stride=stride)
+					pos_msec = (lastframe + stride) * 1000 / self.framerate if self.framerate > 0 else -1 #estimated from the framerate
+					set_checkpoint(zout, lastframe=lastframe, pos_msec=pos_msec, framecount=self.framecount)
+			finally:
+				#ZipFile Close (or the other container, which is moved into place only if completed)
+				if framewriter is not None:
+					framewriter.close(commit=completed)
+				else:
+					zout.close()
+
+		if metadata_exc is not None:
+			raise metadata_exc
+
+		#Only a completed run replaces the output. When interrupted, the temporary file (`zip_streaming`) is kept with its checkpoint
+		#so that `resume` can continue from it, and the archive in RAM (`zip_in_memory`) is discarded.
+		if streaming is not None:
+			#Move the temporary file into place
+			while True:
+				try:
+					streaming.commit()
+				except Exception as exc:
+					traceback.print_exc()
+					if input("PRESS 'r' TO RETRY: ").lower().startswith('r'):
+						continue
+					else:
+						raise exc #rethrow
+				else:
+					break
+	
 		if zip_in_memory:
 			#Write the ZipFile from RAM & close the BytesIO buffer.
 			while True:
@@ -230,28 +557,168 @@ class Runner():
 						raise exc #rethrow
 				else:
 					break
-		
+	
 			mem_buffer.close()
 
-	def save_metadata(self, zout, inpath, shape, original_shape):
+		return written
+
+	def run_batch(self, inpaths, outdir, update=True, container="zip", bucket_multiple=None, fingerprint=False, **kwargs) -> dict:
+		"""
+		Process the inputs with the loaded model, so that it is loaded only once.
+		Each output is `<outdir>/<basename>.<model_type>.<hashval>.depthviewer` (the name the viewer looks for),
+		and is skipped if it is already complete (`depthfile.is_complete()`); incomplete ones are updated.
+		A failed input is reported and skipped. `kwargs` are passed to `run()`.
+
+		With `batch_size`, the images are grouped by their size after the transform (`get_input_size()`)
+		and inferred together with `run_frames()`, then written one by one. The videos are processed as they come.
+		With `bucket_multiple` also, the sizes are rounded up to its multiples, so that the images of similar sizes
+		(e.g. with `keep_aspect_ratio`) share a bucket; they are padded to the bucket size and the outputs are cropped back.
+		The padded outputs are not the same as the unpadded ones: the backbones see the padding, so the depth inside the image changes too.
+		With `fingerprint`, `get_fingerprint()` is stored in the metadata, and an input whose fingerprint matches a complete output in `outdir`
+		is skipped without computing its SHA-256.
+
+		Returns:
+			dict: {"processed": [...], "skipped": [...], "failed": [...]} of the input paths
+		"""
+
+		os.makedirs(outdir, exist_ok=True)
+		ext = {"zip": ".depthviewer", "ffv1": ".mkv", "raw": ".raw"}[container]
+		frameformat = kwargs.get("frameformat", "pgm")
+		batch_size = kwargs.get("batch_size")
+
+		summary = {"processed": [], "skipped": [], "failed": []}
+		frames = 0
+		starttime = time.time()
+
+		#The existing outputs of this model by their fingerprints
+		fingerprints = {} #{inpath: fingerprint}
+		known = {} #{fingerprint: outpath}
+		if fingerprint and update:
+			for name in os.listdir(outdir):
+				if not name.endswith(ext):
+					continue
+				metadata = read_metadata(os.path.join(outdir, name))
+				if metadata is not None and "fingerprint" in metadata and metadata.get("model_type") == str(self.model_type):
+					known[metadata["fingerprint"]] = os.path.join(outdir, name)
+			print(f"{len(known)} existing outputs with fingerprints")
+
+		def process(inpath, outpath, isimage, hashval, computed=None):
+			#Run & record the result
+			nonlocal frames
+
+			try:
+				written = self.run(inpath, outpath, isimage, update=update, container=container, hashval=hashval, fingerprint=fingerprints.get(inpath), computed=computed, **kwargs) or 0
+			except Exception as exc:
+				traceback.print_exc()
+				summary["failed"].append(inpath)
+				return
+
+			frames += written
+			if written == 0 and not is_complete(outpath, isimage=isimage, frameformat=frameformat):
+				print(f"No frames were written: {inpath}")
+				summary["failed"].append(inpath)
+			else:
+				summary["processed"].append(inpath)
+
+		pending = {} #{input size: [(inpath, outpath, hashval, img)]}, the images to be batched
+
+		def process_pending(size):
+			group = pending.pop(size)
+			print(f"Batch of {len(group)} images of {size}: {[inpath for inpath, _, _, _ in group]}")
+
+			try:
+				_, outs = self.run_frames([img for _, _, _, img in group], batch_size=batch_size, pad_to=size if bucket_multiple else None)
+			except Exception as exc:
+				traceback.print_exc()
+				summary["failed"] += [inpath for inpath, _, _, _ in group]
+				return
+
+			for (inpath, outpath, hashval, img), out in zip(group, outs):
+				process(inpath, outpath, True, hashval, computed=(img, out))
+
+		for n, inpath in enumerate(inpaths):
+			print('*'*32)
+			print(f"[{n+1}/{len(inpaths)}] {inpath}")
+
+			try:
+				isimage = inpath.lower().endswith(tuple(IMAGE_EXTS))
+
+				if fingerprint:
+					fingerprints[inpath] = get_fingerprint(inpath)
+					outpath = known.get(fingerprints[inpath])
+					if outpath is not None and is_complete(outpath, isimage=isimage, frameformat=frameformat):
+						print(f"Already complete (fingerprint): {outpath}")
+						summary["skipped"].append(inpath)
+						continue
+
+				hashval = get_sha256(inpath)
+
+				#Same as `DepthFileUtils.GetDepthFileName()` of the viewer
+				outname = f"{os.path.basename(inpath)}.{self.model_type}.{hashval}{ext}"
+				if len(outname) > 250:
+					outname = f"{self.model_type}.{hashval}{ext}"
+				outpath = os.path.join(outdir, outname)
+
+				if update and is_complete(outpath, isimage=isimage, frameformat=frameformat):
+					print(f"Already complete: {outpath}")
+					summary["skipped"].append(inpath)
+					continue
+
+				#Images to be batched
+				if isimage and batch_size is not None:
+					img = self.read_image(inpath)[0]
+					size = self.get_input_size(img)
+					if size is not None:
+						if bucket_multiple:
+							size = tuple(-(-x // bucket_multiple) * bucket_multiple for x in size) #round up
+
+						pending.setdefault(size, []).append((inpath, outpath, hashval, img))
+						if len(pending[size]) >= batch_size:
+							process_pending(size)
+						elif sum(map(len, pending.values())) >= 4 * batch_size:
+							#Bound the memory when the sizes are scattered
+							process_pending(max(pending, key=lambda size: len(pending[size])))
+						continue
+			except Exception as exc:
+				traceback.print_exc()
+				summary["failed"].append(inpath)
+				continue
+
+			process(inpath, outpath, isimage, hashval)
+
+		#The remaining partial batches
+		for size in list(pending.keys()):
+			process_pending(size)
+
+		elapsed = time.time() - starttime
+		print('*'*32)
+		print(f"Processed: {len(summary['processed'])}, skipped: {len(summary['skipped'])}, failed: {len(summary['failed'])}, of {len(inpaths)}")
+		print(f"Took {elapsed :.2f}s, {frames} frames, {frames / max(elapsed, 1e-9) :.2f} frames/s")
+		for inpath in summary["failed"]:
+			print(f"Failed: {inpath}")
+
+		return summary
+
+	def get_input_size(self, img) -> Union[Tuple[int, int], None]:
+		#(width, height) of `img` after the transform, for batching the images of the same size. None if `run_frames()` can't batch them.
+		return None
+
+	def save_metadata(self, zout, inpath, shape, original_shape, frame_range=None, hashval=None, fingerprint=None):
 		"""
 		Args:
 			zout (zipfile.ZipFile): obj to `.writestr()`
 			inpath (str): the path of the input
+			frame_range (tuple | None): (start, end, stride) if only a part of the video is processed
+			hashval (str | None): SHA-256 of the input. Computed if not given.
+			fingerprint (str | None): `get_fingerprint()` of the input, written only if given
 		"""
 
 		print("Saving the metadata.")
 
-		sha256 = hashlib.sha256()
-		with open(inpath, "rb") as fin:
-			while True:
-				datablock = fin.read(128*1024) #buffer it
-				if not datablock:
-					break
-				sha256.update(datablock)
-		hashval = sha256.hexdigest()
+		if hashval is None:
+			hashval = get_sha256(inpath)
 
-		startframe = -1 #since we can't check this is opencv, set it a negative value
+		startframe = -1 #since we can't check this is opencv, set it a negative value. (This is the index of the first frame of the stream, not `frame_range`.)
 
 		original_name = os.path.basename(inpath)
 		framecount = self.framecount
@@ -268,7 +735,7 @@ class Runner():
 		original_height, original_width = original_shape
 
 		metadata = self.get_metadata(hashval=hashval, framecount=framecount, startframe=startframe, width=width, height=height, model_type=model_type, model_params=model_params, depth_map_type=depth_map_type, 
-			original_name=original_name, original_width=original_width, original_height=original_height, original_framerate=original_framerate, timestamp=timestamp, program=program, version=version)
+			original_name=original_name, original_width=original_width, original_height=original_height, original_framerate=original_framerate, timestamp=timestamp, program=program, version=version, frame_range=frame_range, fingerprint=fingerprint)
 		zout.writestr("METADATA.txt", metadata, compresslevel=0)
 
 	def normalize(self, image):
@@ -286,27 +753,51 @@ class Runner():
 
 		return normalized
 	
-	def as_uint8(self, image):
-		maxval = 255
-		image *= maxval
-		image = image.astype(np.uint8)
+	def quantize(self, image, out):
+		"""
+		Min-max normalize `image` into `out` (np.uint8 or np.uint16) in a single pass, without intermediate arrays.
+		Like `normalize()`, a flat image becomes all zeros.
+		"""
 
-		return image
+		if out.dtype == np.uint8:
+			maxval, dtype = 255, cv2.CV_8U
+		elif out.dtype == np.uint16:
+			maxval, dtype = 65535, cv2.CV_16U
+		else:
+			raise ValueError(f"Expecting np.uint8 or np.uint16, received {out.dtype}")
 
-	def get_pgm(self, image) -> bytes:
-		# 1byte per pixel
+		cv2.normalize(image, out, alpha=0, beta=maxval, norm_type=cv2.NORM_MINMAX, dtype=dtype)
+		return out
 
-		image = self.as_uint8(image)
-		if image.dtype != np.uint8: #This line is not needed now
-			raise ValueError("Expecting np.uint8, received {}".format(image.dtype))
+	def get_pgm(self, image, out=None, maxval=255) -> bytearray:
+		"""
+		1byte per pixel, or 2bytes (big-endian) if `maxval` > 255.
+		The header and the pixels are written into one buffer, which is `out` if it is a bytearray of the right size.
+		"""
 
 		height, width = image.shape[:2]
+		header = "P5\n{} {} {}\n".format(width, height, maxval).encode("ascii")
+		dtype = np.uint8 if maxval <= 255 else np.uint16
+
+		size = len(header) + height * width * np.dtype(dtype).itemsize
+		if out is None or len(out) != size:
+			out = bytearray(size)
+		out[:len(header)] = header
+
+		pixels = np.frombuffer(out, dtype=dtype, offset=len(header)).reshape(height, width)
+		self.quantize(image, pixels)
+		if dtype == np.uint16 and sys.byteorder == "little":
+			pixels.byteswap(inplace=True) #PGM is big-endian
+
+		return out
 
-		return b"P5\n" + "{} {} {}\n".format(width, height, 255).encode("ascii") + image.tobytes()
+	def get_pgm16(self, image, out=None) -> bytearray:
+		# 2bytes per pixel
+		return self.get_pgm(image, out=out, maxval=65535)
 
-	def get_metadata(self, hashval, framecount, startframe, width, height, model_type, model_params, depth_map_type, original_name, original_width, original_height, original_framerate, timestamp, program, version) -> str:
+	def get_metadata(self, hashval, framecount, startframe, width, height, model_type, model_params, depth_map_type, original_name, original_width, original_height, original_framerate, timestamp, program, version, frame_range=None, fingerprint=None) -> str:
 
-		metadata = '\n'.join([
+		lines = [
 			f"DEPTHVIEWER",
 			f"hashval={hashval}",
 			f"framecount={framecount}",
@@ -324,9 +815,27 @@ class Runner():
 			f"timestamp={timestamp}",
 			f"program={program}",
 			f"version={version}",
-		])
+		]
+		if fingerprint is not None:
+			lines.insert(2, f"fingerprint={fingerprint}") #after hashval
+		lines += self.get_range_metadata(frame_range)
+
+		metadata = '\n'.join(lines)
 		return metadata
 
+	@staticmethod
+	def get_range_metadata(frame_range) -> list:
+		#Only when a part of the video is processed. (start, end, stride); `end` is exclusive and -1 for the end of the video.
+		if frame_range is None:
+			return []
+
+		range_start, range_end, range_stride = frame_range
+		return [
+			f"range_start={range_start}",
+			f"range_end={range_end if range_end is not None else -1}",
+			f"range_stride={range_stride}",
+		]
+
 	def read_image(self, path):
 		"""
 		Read an image and return a list for the iterator for self.run()
@@ -344,9 +853,15 @@ class Runner():
 
 		return [img]
 
-	def read_video(self, path):
+	def read_video(self, path, startframe=0, start_msec=None, endframe=None, stride=1):
 		"""
 		Read a video and make a generator for self.run()
+
+		Args:
+			startframe (int): the index of the first frame to yield. The capture is sought rather than decoding the frames before it.
+			start_msec (float | None): the position of `startframe` in ms, used when seeking by the frame index fails.
+			endframe (int | None): the index to stop before.
+			stride (int): yield every `stride`th frame. The ones between are skipped with `skip_frames()`.
 		"""
 
 		buffer = None
@@ -363,7 +878,22 @@ class Runner():
 		self.framecount = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 		self.framerate = float(cap.get(cv2.CAP_PROP_FPS))
 
+		#For this video only: set to inf if seeking falls back to grabbing
+		min_seek_distance = self.min_seek_distance
+
+		if startframe > 0 and not self.seek_video(cap, startframe, start_msec):
+			min_seek_distance = float("inf")
+
+		i = startframe
 		while cap.isOpened():
+			if endframe is not None and i >= endframe:
+				break
+
+			#Skip to #i
+			if i > startframe and stride > 1:
+				if not self.skip_frames(cap, i - stride + 1, i, min_seek_distance):
+					min_seek_distance = float("inf") #Don't seek this one again
+
 			ret, frame = cap.read()
 			if not ret:
 				print("Can't receive frame (stream end?). Exiting ...")
@@ -382,6 +912,7 @@ class Runner():
 					frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_AREA)
 
 			yield self.as_input(frame)
+			i += stride
 
 		cap.release()
 		#cv2.destroyAllWindows()
@@ -389,15 +920,60 @@ class Runner():
 		if buffer:
 			buffer.close()
 
+	def seek_video(self, cap, startframe, start_msec=None):
+		"""
+		Seek `cap` so that the next `cap.read()` returns the frame #`startframe`.
+		Falls back to grabbing the frames one by one when the backend can not seek accurately.
+
+		Returns:
+			bool: False if it fell back to grabbing
+		"""
+
+		print(f"Seeking to #{startframe}...")
+		cap.set(cv2.CAP_PROP_POS_FRAMES, startframe)
+		pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+		if pos != startframe and start_msec is not None and start_msec >= 0:
+			print(f"Landed on #{pos}. Seeking to {start_msec :.2f}ms...")
+			cap.set(cv2.CAP_PROP_POS_MSEC, start_msec)
+			pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+		if pos != startframe:
+			print(f"Landed on #{pos}. Grabbing the frames from the start instead.")
+			cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+			for _ in range(startframe):
+				if not cap.grab(): #skips retrieving & converting the image
+					break
+			return False
+
+		return True
+
+	def skip_frames(self, cap, pos, target, min_seek_distance):
+		"""
+		Advance `cap` from #`pos` (the frame the next `cap.read()` would return) to #`target`.
+		Near frames (up to `min_seek_distance`) are grabbed; far ones are sought, since seeking decodes from the keyframe before the target anyway.
+
+		Returns:
+			bool: False if seeking fell back to grabbing
+		"""
+
+		if target - pos > min_seek_distance:
+			return self.seek_video(cap, target, start_msec=target * 1000 / self.framerate if self.framerate > 0 else None)
+
+		for _ in range(target - pos):
+			if not cap.grab():
+				break
+		return True
+
 	def as_input(self, img):
 		"""
 		Set img for the input format
-		as [0, 1]
+		as uint8 RGB. It is converted to float32 [0, 1] by the runners (`ToFloatImage`, before the cubic resize), rather than as float64 here.
 		"""
 
 		if img.ndim == 2:
 			img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-		img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) / 255.0
+		img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
 		return img
 
@@ -433,9 +1009,24 @@ class Runner():
 
 		return pfm
 	
+	def get_frame_encoder(self, frameformat, keyframe_interval=30):
+		"""
+		Returns a function (index, image) -> frame file.
+		The frames should be given in the order they are written, since the delta formats depend on the previous frame.
+		"""
+
+		if frameformat in ["pgmdelta", "pgm16delta"]:
+			dtype = np.uint16 if frameformat == "pgm16delta" else np.uint8
+			encoder = DeltaEncoder(keyframe_interval=keyframe_interval)
+			return lambda i, image: encoder.encode(i, self.quantize(image, np.empty(image.shape[:2], dtype=dtype)))
+		else:
+			return lambda i, image: self.get_framefile(image, frameformat)
+
 	def get_framefile(self, image, frameformat):
 		if frameformat == "pgm":
 			return self.get_pgm(image)
+		elif frameformat == "pgm16":
+			return self.get_pgm16(image)
 		elif frameformat == "pfm":
 			return self.get_pfm(image)
 		else:
@@ -451,7 +1042,14 @@ class PyTorchRunner(Runner):
 		self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 		print("device: %s" % self.device)
 
-	def load_model(self, model_type="dpt_beit_large_512", optimize=False, height=None, square=None, strict=True):
+		self.batch_transform = None
+		self.device_transform = None
+
+		#With `compile_model`, the compiled models per (model_type, model_params, input shape, dtype); `None` if it failed (eager)
+		self.compile_enabled = False
+		self.compiled_models = {}
+
+	def load_model(self, model_type="dpt_beit_large_512", optimize=False, height=None, square=None, strict=True, device_transform=False, sdpa=False, compile_model=False):
 		new_model_params = ModelParams(optimize=optimize, height=height, square=square, strict=strict)
 
 		#check if the model exists
@@ -461,6 +1059,9 @@ class PyTorchRunner(Runner):
 
 		#check if it's the already loaded
 		if self.model_type == model_type and self.model_params == new_model_params:
+			self.set_device_transform(device_transform)
+			self.set_sdpa(sdpa)
+			self.set_compile(compile_model)
 			return
 
 		print(f"Loading model {model_type}...")
@@ -469,6 +1070,8 @@ class PyTorchRunner(Runner):
 		orig_cwd = os.getcwd()
 		os.chdir(os.path.dirname(os.path.abspath(__file__)))
 		self.model, self.transform, self.net_w, self.net_h = load_model(self.device, model_path, model_type, optimize, height, square, strict)
+		self.compiled_models = {} #they wrap the previous model
+		self.batch_transform = PrepareBatchForNet.from_compose(self.transform) #for `run_frames()`
 		os.chdir(orig_cwd)
 
 		print("Loaded the model.")
@@ -476,11 +1079,111 @@ class PyTorchRunner(Runner):
 		self.model_type = model_type
 		self.model_params = new_model_params
 
+		self.set_device_transform(device_transform)
+		self.set_sdpa(sdpa)
+		self.set_compile(compile_model)
+
+	def get_input_size(self, img):
+		if self.batch_transform is None or "openvino" in self.model_type:
+			return None
+		return tuple(int(x) for x in self.batch_transform.get_size(img))
+
+	def set_device_transform(self, enabled):
+		#If enabled, the frames are uploaded as they are and resized & normalized on `self.device`
+		self.device_transform = None
+		if not enabled:
+			return
+
+		if "openvino" in self.model_type:
+			print("The device transform is not supported on OpenVINO models.")
+			return
+
+		self.device_transform = PrepareBatchOnDevice.from_compose(self.transform, self.device)
+		if self.device_transform is None:
+			print("The device transform is not supported on this transform.")
+		else:
+			print("Using the device transform.")
+
+	def set_sdpa(self, enabled):
+		#If enabled, the attentions of the BEiT models use `F.scaled_dot_product_attention` (fused kernels, no N*N attention matrix)
+		if not enabled:
+			set_sdpa(False)
+			return
+
+		if "beit" not in self.model_type:
+			print("SDPA is only used by the BEiT models.")
+			return
+
+		if set_sdpa(True):
+			print("Using SDPA.")
+		else:
+			print("SDPA is not supported by this PyTorch version.")
+
+	def set_compile(self, enabled):
+		#If enabled, the model is compiled (`torch.compile`, or `torch.jit.trace` on torch<2.0) per input shape on its first use
+		self.compile_enabled = False
+		if not enabled:
+			return
+
+		if "openvino" in self.model_type:
+			print("Compiling is not supported on OpenVINO models.")
+			return
+
+		self.compile_enabled = True
+		print("Using the compiled model.")
+
+	def make_compiled_model(self, sample):
+		#Returns the compiled model for the shape of `sample`. `torch.compile()` is lazy; it compiles on the first call
+		if hasattr(torch, "compile"):
+			return torch.compile(self.model, dynamic=False)
+
+		with torch.no_grad():
+			return torch.jit.freeze(torch.jit.trace(self.model, sample))
+
+	def forward(self, sample):
+		#`self.model.forward()`, through the compiled model for the input if enabled. Falls back to eager if compiling fails
+		if not self.compile_enabled:
+			return self.model.forward(sample)
+
+		key = (self.model_type, str(self.model_params), tuple(sample.shape), str(sample.dtype))
+		if key in self.compiled_models and self.compiled_models[key] is None:
+			return self.model.forward(sample)
+
+		try:
+			if key not in self.compiled_models:
+				print(f"Compiling the model for {tuple(sample.shape)}...")
+				start = time.perf_counter()
+				compiled = self.make_compiled_model(sample)
+				prediction = compiled(sample)
+				print(f"Compiled in {time.perf_counter() - start :.1f}s.")
+				self.compiled_models[key] = compiled
+				return prediction
+
+			return self.compiled_models[key](sample)
+		except Exception:
+			traceback.print_exc()
+			print(f"Failed to run the compiled model for {tuple(sample.shape)}. Falling back to eager.")
+			self.compiled_models[key] = None
+			return self.model.forward(sample)
+
 	def run_frame(self, img):
 		#Should be identical to `return run_frames([img])[1][0]`. Left for compability
+		return self.run_prepared_frame(self.prepare_frame(img))
+
+	def prepare_frame(self, img):
+		#The transform on the CPU. With the device transform, the image as it is (transformed in `run_prepared_frame()`)
+		if self.device_transform is not None:
+			return img, None
+		return img, self.transform({"image": img})["image"]
+
+	def run_prepared_frame(self, prepared):
+		img, img_input = prepared
 
 		# input
-		img_input = self.transform({"image": img})["image"]
+		if img_input is None:
+			sample = self.device_transform([img])
+		else:
+			sample = None
 
 		# compute
 		with torch.no_grad():
@@ -489,39 +1192,72 @@ class PyTorchRunner(Runner):
 				sample = [np.reshape(img_input, (1, 3, self.net_w, self.net_h))]
 				prediction = self.model(sample)[self.model.output(0)][0]
 			else:
-				sample = torch.from_numpy(img_input).to(self.device).unsqueeze(0)
+				if sample is None:
+					sample = torch.from_numpy(img_input).to(self.device).unsqueeze(0)
 				if self.model_params.optimize == True and self.device == torch.device("cuda"):
 					sample = sample.to(memory_format=torch.channels_last)  
 					sample = sample.half()
-				prediction = self.model.forward(sample)
+				prediction = self.forward(sample)
 				prediction = prediction.squeeze().cpu().numpy()
 
 		# output
 		out = self.normalize(prediction)
 		return out
 	
-	def run_frames(self, imgs: Iterable, batch_size) -> Tuple[int, np.ndarray]:
+	def run_frames(self, imgs: Iterable, batch_size, pad_to=None) -> Tuple[int, np.ndarray]:
 		#Returns the number of valid frames and an ndarray of shape (batch_size, ...)
+		#With `pad_to`, a list of the valid frames each cropped back to the size of its image
+		return self.run_prepared_frames(self._prepare_frames(imgs, batch_size, pad_to=pad_to, copy=False), batch_size, pad_to=pad_to)
 
-		#Stack
-		frames = []
-		for i, img in enumerate(imgs):
-			if i >= batch_size:
-				break
+	def prepare_frames(self, imgs: Iterable, batch_size, pad_to=None):
+		#Returns the images and their transformed batch (padded with dummy frames),
+		#or `None` for the latter with the device transform (transformed in `run_prepared_frames()`)
+		return self._prepare_frames(imgs, batch_size, pad_to=pad_to, copy=True)
+
+	def _prepare_frames(self, imgs, batch_size, pad_to=None, copy=True):
+
+		imgs = list(itertools.islice(imgs, batch_size))
 
-			frame = self.transform({"image": img})["image"]
-			frames.append(frame)
+		#Empty frames
+		if imgs == []:
+			return imgs, None
+		empty = batch_size - len(imgs)
+
+		if pad_to is not None and self.batch_transform is None:
+			raise ValueError("`pad_to` needs the batch transform.")
+
+		#The device transform needs the images of the same size (`run_batch()` groups them by the resized size)
+		if self.device_transform is not None and pad_to is None and all(img.shape[:2] == imgs[0].shape[:2] for img in imgs):
+			return imgs, None
+		elif self.batch_transform is not None:
+			#Transform the whole batch at once, padded with dummy frames
+			frames = self.batch_transform(imgs, batch_size=batch_size, pad_to=pad_to)
+			if copy:
+				frames = frames.copy() #The batch transform reuses the array, while the prepared batches may wait in a queue
+		else:
+			#Stack
+			frames = [self.transform({"image": img})["image"] for img in imgs]
+
+			#Add dummy frames
+			for _ in range(empty):
+				frames.append(np.zeros_like(frames[0]))
+
+			frames = np.stack(frames)
+
+		return imgs, frames
+
+	def run_prepared_frames(self, prepared, batch_size, pad_to=None) -> Tuple[int, np.ndarray]:
+		imgs, frames = prepared
 
 		#Empty frames
-		if frames == []:
+		if imgs == []:
 			return 0, None
-		
-		#Add dummy frames
-		empty = batch_size - len(frames)
-		for _ in range(empty):
-			frames.append(np.zeros_like(frames[0]))
+		empty = batch_size - len(imgs)
 
-		frames = np.stack(frames)
+		sample = None
+		if frames is None:
+			#Transform the whole batch on the device, padded with dummy frames
+			sample = self.device_transform(imgs, batch_size=batch_size)
 
 		#Compute
 		with torch.no_grad():
@@ -532,13 +1268,23 @@ class PyTorchRunner(Runner):
 				#prediction = self.model(sample)[self.model.output(0)]
 				raise NotImplementedError("Batch inference on OpenVINO models is not implemented yet (please make a GitHub issue)")
 			else:
-				sample = torch.from_numpy(frames).to(self.device)
+				if sample is None:
+					sample = torch.from_numpy(frames).to(self.device)
 				if self.model_params.optimize == True and self.device == torch.device("cuda"):
 					sample = sample.to(memory_format=torch.channels_last)
 					sample = sample.half()
-				prediction = self.model.forward(sample)
+				prediction = self.forward(sample)
 				prediction = prediction.cpu().numpy()
 
+		if pad_to is not None:
+			#Crop out the padding (in proportion, in case the output is smaller than the input), then normalize
+			outs = []
+			pred_h, pred_w = prediction.shape[-2:]
+			for i, img in enumerate(imgs):
+				w, h = self.batch_transform.get_size(img)
+				outs.append(self.normalize(prediction[i, :round(pred_h * h / pad_to[1]), :round(pred_w * w / pad_to[0])]))
+			return len(imgs), outs
+
 		#Normalize, per frame
 		for i in range(batch_size):
 			prediction[i] = self.normalize(prediction[i])
@@ -569,6 +1315,28 @@ def add_runner_argparser(parser):
 		'images is tried to be preserved if supported by the model.'
 	)
 
+	parser.add_argument("--device_transform",
+		help="(`pt` only) Upload the raw frames and resize & normalize them on the torch device.",
+		action="store_true",
+	)
+
+	parser.add_argument("--sdpa",
+		help="(`pt` only, BEiT models) Use `torch.nn.functional.scaled_dot_product_attention` for the attentions, which uses less memory and is usually faster. The outputs differ slightly due to the float rounding.",
+		action="store_true",
+	)
+
+	parser.add_argument("--rel_pos_cache",
+		help="(`pt` only, BEiT models) Max. MiB of the relative position biases kept between the frames, for all the blocks. "
+			"Each block needs heads * (number of patches + 1)^2 float32s: all the blocks of dpt_beit_base_384 take 183MiB at 384x384 & 577MiB at 512x512, "
+			"those of dpt_beit_large_512 1.5GiB at 512x512. The blocks that do not fit recompute it every frame. 0 to disable.",
+		type=int, default=REL_POS_BIAS_CACHE_MIB,
+	)
+
+	parser.add_argument("--compile",
+		help="(`pt` only) Compile the model (`torch.compile`, or TorchScript on torch<2.0) per input shape on its first use, falling back to eager if it fails. Slow to start, but faster per frame on long videos.",
+		action="store_true",
+	)
+
 	parser.add_argument("--aux_args",
 		help="(experimental) Auxiliary args used in `load_model`. Does not support escape sequences.",
 		default=None,				 
@@ -596,7 +1364,8 @@ def get_loaded_runner(args):
 
 	if args.runner == "pt":
 		runner = PyTorchRunner()
-		runner.load_model(model_type=model_type, optimize=args.optimize, height=args.height, square=args.square, strict=not args.nostrict)
+		runner.load_model(model_type=model_type, optimize=args.optimize, height=args.height, square=args.square, strict=not args.nostrict, device_transform=args.device_transform, sdpa=args.sdpa, compile_model=args.compile)
+		set_rel_pos_bias_cache(args.rel_pos_cache)
 	elif args.runner == "ort":
 		from ortrunner import OrtRunner
 		runner = OrtRunner()
@@ -622,6 +1391,94 @@ def get_loaded_runner(args):
 	
 	return runner
 
+def get_batch_inputs(source) -> list:
+	"""
+	The inputs of `--batch`: the images & videos in a directory (not recursive), the paths listed in a text file (one per line),
+	or the files matching a glob pattern.
+	"""
+
+	if os.path.isdir(source):
+		paths = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+		return [path for path in paths if os.path.isfile(path) and path.lower().endswith(tuple(IMAGE_EXTS + VIDEO_EXTS))]
+	elif os.path.isfile(source):
+		with open(source, "r", encoding="utf-8") as fin:
+			return [line.strip() for line in fin if line.strip() != "" and not line.startswith('#')]
+	else:
+		return sorted(glob.glob(source, recursive=True))
+
+def run_shard(args, start, end, outpath, threads, fingerprint):
+	#The worker process of `run_sharded()`. The hash is left empty in the partial file; `run_sharded()` computes it once & fills it in the merged one.
+	torch.set_num_threads(threads)
+
+	runner = get_loaded_runner(args)
+	runner.run(inpath=args.input, outpath=outpath, isimage=False, zip_in_memory=False, update=not args.noupdate, resume=args.resume, keyframe_interval=args.keyframe_interval,
+		start=start, end=end, stride=args.stride, hashval="", fingerprint=fingerprint,
+		batch_size=args.batch_size, frameformat=args.frameformat, pipeline=args.pipeline, zip_workers=args.zip_workers)
+
+def run_sharded(args):
+	"""
+	Split the frame range of the video into `args.workers` contiguous ranges, process each of them in a process with its own runner,
+	and merge the partial depthfiles (`<output>.part<k>`) into `args.output`.
+	The CPU threads are divided between the workers. The partial files are kept if any of the workers fails, so that it can be resumed.
+	"""
+
+	cap = cv2.VideoCapture(args.input)
+	framecount = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+	cap.release()
+
+	end = args.end if args.end is not None else framecount
+	indices = range(args.start, end, args.stride)
+	workers = min(args.workers, len(indices))
+	if workers < 1:
+		print(f"ERROR: No frames to process in {args.input} (framecount: {framecount})")
+		return
+
+	#Split the indices evenly. The last one runs to `args.end`, since the framecount may be inaccurate.
+	bounds = [indices[k * len(indices) // workers] for k in range(workers)] + [args.end]
+	threads = args.threads if args.threads is not None else max(1, (os.cpu_count() or 1) // workers)
+	print(f"Workers: {workers}, threads per worker: {threads}, bounds: {bounds}")
+
+	#Inherited by the workers, for the libraries that read them on the import
+	for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+		os.environ[var] = str(threads)
+
+	#The input is hashed once, here, while the workers run (rather than read whole by each of them)
+	get_hashval = get_sha256_async(args.input)
+	fingerprint = get_fingerprint(args.input) if args.fingerprint else None
+
+	partpaths = [f"{args.output}.part{k}" for k in range(workers)]
+	ctx = multiprocessing.get_context("spawn") #fresh interpreters, not copies of this one
+	procs = []
+	for k in range(workers):
+		proc = ctx.Process(target=run_shard, args=(args, bounds[k], bounds[k+1], partpaths[k], threads, fingerprint))
+		proc.start()
+		procs.append(proc)
+
+	for proc in procs:
+		proc.join()
+
+	failed = [k for k, proc in enumerate(procs) if proc.exitcode != 0]
+	if failed:
+		print(f"ERROR: Worker(s) {failed} failed. Run it again (with `--resume`) to continue from the partial files.")
+		return
+
+	#Merge, with one METADATA.txt for the whole range
+	inpaths = partpaths
+	if not args.noupdate and os.path.exists(args.output):
+		inpaths = [args.output] + inpaths
+
+	with zipfile.ZipFile(partpaths[0], "r") as zin:
+		metadata = zin.read("METADATA.txt").decode("utf-8")
+	hashval = get_hashval()
+	metadata = [f"hashval={hashval}" if line.startswith("hashval=") else line for line in metadata.split('\n') if not line.startswith("range_")]
+	frame_range = (args.start, args.end, args.stride) if (args.start, args.end, args.stride) != (0, None, 1) else None
+	metadata = '\n'.join(metadata + Runner.get_range_metadata(frame_range))
+
+	merge_depthfiles(inpaths, args.output, metadata)
+
+	for partpath in partpaths:
+		os.remove(partpath)
+
 #######################
 
 if __name__ == "__main__":
@@ -641,26 +1498,117 @@ if __name__ == "__main__":
 			action="store_true"
 		)
 
+		parser.add_argument("--batch",
+			help="Treat `input` as a directory, a text file listing the inputs, or a glob pattern, and `output` as the output directory. "
+				"The model is loaded once, and the inputs whose outputs are already complete are skipped.",
+			action="store_true"
+		)
+
 		parser.add_argument("--zip_in_memory",
 			help="Whether zip the file in RAM and dump on the disk only after it finishes.",
 			action="store_true"
 		)
 
+		parser.add_argument("--zip_streaming",
+			help="Write the ZIP file to a temporary file on the disk and rename it only after it finishes. Overrides `--zip_in_memory`.",
+			action="store_true"
+		)
+
 		parser.add_argument("--noupdate",
 			help="Replace existing file.",
 			action="store_true"
 		)
 
+		parser.add_argument("--resume",
+			help="Seek the video to the checkpoint recorded in the existing output instead of decoding it from the start.",
+			action="store_true"
+		)
+
+		parser.add_argument("--start",
+			help="(Video) the index of the first frame to process. The video is sought to it.",
+			type=int,
+			default=0,
+		)
+
+		parser.add_argument("--end",
+			help="(Video) the index of the frame to stop before. Defaults to the end of the video.",
+			type=int,
+			default=None,
+		)
+
+		parser.add_argument("--stride",
+			help="(Video) process every Nth frame from `--start`, e.g. for a low-fps preview. The frame files keep the indices of the video.",
+			type=int,
+			default=1,
+		)
+
+		parser.add_argument("--fingerprint",
+			help="Also store a fast fingerprint of the input (the size & sampled blocks) in the metadata, along with the SHA-256. "
+				"With `--batch`, the inputs whose fingerprints match complete outputs are skipped without computing the SHA-256.",
+			action="store_true"
+		)
+
+		parser.add_argument("--bucket_multiple",
+			help="With `--batch` & `--batch_size`, round the input sizes of the images up to multiples of this (a multiple of 32, e.g. 128) "
+				"so that the images of similar aspect ratios are batched together, padded. The outputs are cropped back. "
+				"Faster, but the outputs differ from the unpadded inference (the padding changes the depth inside the image as well, "
+				"since the ViT & conv. backbones see the whole input).",
+			type=int,
+			default=None,
+		)
+
+		parser.add_argument("--workers",
+			help="(Video) split the frames between this many processes, each with its own model, and merge their outputs. Only for the zip container.",
+			type=int,
+			default=None,
+		)
+
+		parser.add_argument("--threads",
+			help="With `--workers`, the number of CPU threads per worker. Defaults to the number of CPUs divided by the number of workers.",
+			type=int,
+			default=None,
+		)
+
 		parser.add_argument("--batch_size",
 			help="Batch size (experimental)",
 			type=int,
 			default=None,
 		)
 
+		parser.add_argument("--pipeline",
+			help="Run decoding, inference and writing concurrently on separate threads.",
+			action="store_true",
+		)
+
+		parser.add_argument("--container",
+			help="`zip`: the depthfile (default). "
+				"`ffv1`: a lossless grayscale FFV1 video in Matroska (needs ffpyplayer), with the metadata in `<output>.METADATA.txt`. "
+				"16-bit if `--frameformat` is `pgm16` or `pgm16delta`, else 8-bit. "
+				"`raw`: all frames in one fixed-stride array file with the metadata in its header, for `np.memmap()` (see `depthfile.RawDepthReader`). "
+				"uint16 for `pgm16` & `pgm16delta`, float16 (not normalized) for `pfm`, else uint8.",
+			default="zip",
+			choices=["zip", "ffv1", "raw"],
+		)
+
+		parser.add_argument("--zip_workers",
+			help="Number of threads to compress the frame files with. By default they are compressed on the writing thread.",
+			type=int,
+			default=None,
+		)
+
 		default_frameformat = "pgm"
 		parser.add_argument("--frameformat",
-			help=f"The format of the frame file. Defaults to {default_frameformat}.",
+			help=f"The format of the frame file. Defaults to {default_frameformat}. "
+				"`pgm16` is a 16-bit PGM (as `N.pgm16`, not readable by DepthViewer), which is more precise than `pgm` and smaller than `pfm`. "
+				"`pgmdelta` and `pgm16delta` store residuals against the previous frame between keyframes (not readable by DepthViewer).",
 			default=default_frameformat,
+			choices=["pgm", "pgm16", "pfm", "pgmdelta", "pgm16delta"],
+		)
+
+		parser.add_argument("--keyframe_interval",
+			help="For `pgmdelta` and `pgm16delta`, the max. distance between keyframes. Defaults to 30.",
+			type=int,
+			default=30,
 		)
 
 		parser.add_argument("--detect_img_exts",
@@ -678,20 +1626,45 @@ if __name__ == "__main__":
 		print(f"batch_size: {args.batch_size}")
 
 		#Check if the input is of image ext but (not args.image)
-		if any(map(args.input.endswith, [".jpg", ".jpeg", ".png"])) and not args.image:
+		if any(map(args.input.endswith, IMAGE_EXTS)) and not args.image and not args.batch:
 			if args.detect_img_exts:
 				print("Image ext detected, using cv2.imread().")
 				args.image = True
 			else:
 				print("Warning: input has an image ext but `-i` was not given.")
 
-		if not args.noupdate and args.image and os.path.exists(args.output):
+		if args.bucket_multiple is not None:
+			if args.bucket_multiple <= 0 or args.bucket_multiple % 32 != 0:
+				raise ValueError("`--bucket_multiple` must be a positive multiple of 32.")
+			if not args.batch or args.batch_size is None:
+				print("Warning: `--bucket_multiple` is ignored without `--batch` & `--batch_size`.")
+
+		if not args.noupdate and args.image and not args.batch and os.path.exists(args.output):
 			print(f"Image: already exists: {args.output}. Use --noupdate to replace it.")
 			exit(0)
 
-		runner = get_loaded_runner(args)
-		outs = runner.run(inpath=args.input, outpath=args.output, isimage=args.image, zip_in_memory=args.zip_in_memory, update=not args.noupdate,
-			batch_size=args.batch_size, frameformat=args.frameformat)
+		if args.batch:
+			if args.workers is not None and args.workers > 1:
+				raise ValueError("`--workers` can't be used with `--batch`.")
+
+			inpaths = get_batch_inputs(args.input)
+			print(f"{len(inpaths)} inputs")
+
+			runner = get_loaded_runner(args)
+			runner.run_batch(inpaths, args.output, update=not args.noupdate, container=args.container, bucket_multiple=args.bucket_multiple, fingerprint=args.fingerprint,
+				zip_in_memory=args.zip_in_memory, zip_streaming=args.zip_streaming, resume=args.resume, keyframe_interval=args.keyframe_interval,
+				start=args.start, end=args.end, stride=args.stride,
+				batch_size=args.batch_size, frameformat=args.frameformat, pipeline=args.pipeline, zip_workers=args.zip_workers)
+		elif args.workers is not None and args.workers > 1:
+			if args.image or args.container != "zip":
+				raise ValueError("`--workers` is only for videos with the zip container.")
+
+			run_sharded(args)
+		else:
+			runner = get_loaded_runner(args)
+			outs = runner.run(inpath=args.input, outpath=args.output, isimage=args.image, zip_in_memory=args.zip_in_memory, zip_streaming=args.zip_streaming, update=not args.noupdate, resume=args.resume, keyframe_interval=args.keyframe_interval, container=args.container,
+				start=args.start, end=args.end, stride=args.stride, fingerprint=get_fingerprint(args.input) if args.fingerprint else None,
+				batch_size=args.batch_size, frameformat=args.frameformat, pipeline=args.pipeline, zip_workers=args.zip_workers)
 
 		print("Done.")
 	except Exception as exc:
@@ -0,0 +1,640 @@
+"""
+Helpers for writing & reading depthfiles (ZIP archives of the frame files & METADATA.txt),
+and the alternative containers (FFV1 video & raw array file).
+"""
+
+import os
+import shutil
+import zipfile
+import zlib
+import struct
+import time
+import collections
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+RAW_HEADER_SIZE = 4096 #page-aligned frames
+
+def compress_entry(name, data, compresslevel=5):
+	"""
+	Deflate `data` for the entry `name` without touching the archive.
+	This can be called from any thread (zlib releases the GIL while compressing).
+
+	Returns:
+		(zipfile.ZipInfo, bytes): the entry info and the raw deflate stream
+	"""
+
+	zinfo = zipfile.ZipInfo(filename=name, date_time=time.localtime(time.time())[:6])
+	zinfo.compress_type = zipfile.ZIP_DEFLATED
+	zinfo.external_attr = 0o600 << 16 #?rw-------, same as `ZipFile.writestr()`
+
+	compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15) #raw deflate, as in zip
+	cdata = compressor.compress(data) + compressor.flush()
+
+	zinfo.file_size = len(data)
+	zinfo.compress_size = len(cdata)
+	zinfo.CRC = zlib.crc32(data)
+
+	return zinfo, cdata
+
+def write_compressed(zout, zinfo, cdata):
+	"""
+	Append an entry compressed by `compress_entry()` to `zout`.
+	`zout.fp` should be seekable.
+	"""
+
+	with zout._lock:
+		if zout._writing:
+			raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+
+		zout.fp.seek(zout.start_dir)
+		zinfo.header_offset = zout.fp.tell()
+		zout._writecheck(zinfo)
+		zout._didModify = True
+
+		zout.fp.write(zinfo.FileHeader())
+		zout.fp.write(cdata)
+		zout.start_dir = zout.fp.tell()
+
+		zout.filelist.append(zinfo)
+		zout.NameToInfo[zinfo.filename] = zinfo
+
+def read_compressed(zin, zinfo):
+	"""
+	Read an entry of `zin` as it is stored, without decompressing it.
+
+	Returns:
+		(zipfile.ZipInfo, bytes): a new entry info & the compressed data, for `write_compressed()`
+	"""
+
+	with zin._lock:
+		zin.fp.seek(zinfo.header_offset)
+		fheader = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+		zin.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+		cdata = zin.fp.read(zinfo.compress_size)
+
+	newinfo = zipfile.ZipInfo(filename=zinfo.filename, date_time=zinfo.date_time)
+	newinfo.compress_type = zinfo.compress_type
+	newinfo.external_attr = zinfo.external_attr
+	newinfo.file_size = zinfo.file_size
+	newinfo.compress_size = zinfo.compress_size
+	newinfo.CRC = zinfo.CRC
+
+	return newinfo, cdata
+
+def merge_depthfiles(inpaths, outpath, metadata):
+	"""
+	Merge the frame files of the depthfiles `inpaths` into a new depthfile `outpath` with `metadata` as its METADATA.txt.
+	The entries are copied as they are stored, without recompressing them. If a frame is in several of them, the first one is used.
+	`outpath` is written to a temporary file and moved into place when it is done.
+	"""
+
+	tmppath = outpath + ".tmp"
+	with zipfile.ZipFile(tmppath, "w", compression=zipfile.ZIP_DEFLATED) as zout:
+		zout.writestr("METADATA.txt", metadata, compresslevel=0)
+
+		for inpath in inpaths:
+			print(f"Merging {inpath}...")
+			with zipfile.ZipFile(inpath, "r") as zin:
+				for zinfo in zin.infolist():
+					if zinfo.filename in zout.NameToInfo:
+						continue
+
+					write_compressed(zout, *read_compressed(zin, zinfo))
+
+	os.replace(tmppath, outpath)
+
+class ParallelZipWriter():
+	"""
+	Compresses the entries in a thread pool and appends them to the archive in the order they were given.
+	"""
+
+	def __init__(self, zout, workers, compresslevel=5, max_pending=None):
+		self.zout = zout
+		self.compresslevel = compresslevel
+		self.max_pending = max_pending if max_pending is not None else 2 * workers
+
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.pending = collections.deque()
+
+		#Throughput counter
+		self.entries = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.starttime = time.time()
+
+	def writestr(self, name, data):
+		self.pending.append(self.executor.submit(compress_entry, name, data, self.compresslevel))
+
+		#Write the ones that are done, and block if there are too many in flight
+		while self.pending and (self.pending[0].done() or len(self.pending) > self.max_pending):
+			self._write_next()
+
+	def _write_next(self):
+		zinfo, cdata = self.pending.popleft().result()
+		write_compressed(self.zout, zinfo, cdata)
+
+		self.entries += 1
+		self.bytes_in += zinfo.file_size
+		self.bytes_out += zinfo.compress_size
+
+	def flush(self):
+		while self.pending:
+			self._write_next()
+
+	def close(self):
+		try:
+			self.flush()
+		finally:
+			self.executor.shutdown(wait=True, cancel_futures=True)
+
+		print(self.get_stats())
+
+	def get_stats(self) -> str:
+		elapsed = max(time.time() - self.starttime, 1e-9)
+		mib = 1024 * 1024
+		return (f"ParallelZipWriter: {self.entries} entries, {self.bytes_in / mib :.2f}MiB -> {self.bytes_out / mib :.2f}MiB, "
+			f"{self.entries / elapsed :.2f} entries/s, {self.bytes_in / mib / elapsed :.2f}MiB/s")
+
+class StreamingTarget():
+	"""
+	Lets the archive be written to a temporary file next to `outpath`, which is renamed into place by `commit()`.
+	Like `--zip_in_memory`, `outpath` is never left half-written, but the memory use does not grow with the archive.
+	If the run fails, the caller does not commit and the temporary file is left; with `resume`, it is continued from
+	rather than copied over from `outpath`.
+	"""
+
+	def __init__(self, outpath, update, resume=False, flush_every=64):
+		self.outpath = outpath
+		self.path = outpath + ".tmp"
+		self.flush_every = flush_every
+		self.count = 0
+
+		if update and resume and zipfile.is_zipfile(self.path):
+			print(f"Continuing from {self.path}")
+		elif update and os.path.exists(outpath):
+			print(f"Copying {outpath} to {self.path}...")
+			shutil.copyfile(outpath, self.path) #disk to disk
+		elif os.path.exists(self.path):
+			os.remove(self.path) #leftover
+
+	def written(self, zout):
+		#To be called after each entry
+		self.count += 1
+		if self.count % self.flush_every == 0:
+			zout.fp.flush()
+			os.fsync(zout.fp.fileno())
+
+	def commit(self):
+		os.replace(self.path, self.outpath)
+
+def get_checkpoint(zfile):
+	"""
+	Read the checkpoint recorded by `set_checkpoint()`.
+
+	Returns:
+		dict | None: {"lastframe": int, "pos_msec": float, "framecount": int}
+	"""
+
+	lines = zfile.comment.decode("utf-8", errors="replace").split('\n')
+	if lines[0] != "DEPTHVIEWER_CHECKPOINT":
+		return None
+
+	checkpoint = {}
+	for line in lines[1:]:
+		if '=' not in line:
+			continue
+		k, v = line.split('=', maxsplit=1)
+		checkpoint[k] = v
+
+	try:
+		return {
+			"lastframe": int(checkpoint["lastframe"]),
+			"pos_msec": float(checkpoint["pos_msec"]),
+			"framecount": int(checkpoint["framecount"]),
+		}
+	except (KeyError, ValueError):
+		print(f"Invalid checkpoint: {checkpoint}")
+		return None
+
+def set_checkpoint(zout, lastframe, pos_msec, framecount):
+	"""
+	Record the last completed frame & the decoder position after it.
+	This is stored as the archive comment, so that it can be replaced without adding an entry.
+	"""
+
+	zout.comment = '\n'.join([
+		f"DEPTHVIEWER_CHECKPOINT",
+		f"lastframe={lastframe}",
+		f"pos_msec={pos_msec}",
+		f"framecount={framecount}",
+	]).encode("utf-8")
+
+def get_last_contiguous(namelist, frameformat, start=0, stride=1) -> int:
+	"""
+	Returns the last index `i` where all of `{start}.{frameformat}`, `{start+stride}.{frameformat}`, ..., `{i}.{frameformat}` exist.
+	`start - stride` if there is none.
+	"""
+
+	names = set(namelist)
+
+	i = start
+	while f"{i}.{frameformat}" in names:
+		i += stride
+	return i - stride
+
+def read_metadata(path):
+	"""
+	Read METADATA.txt of an output: a depthfile, a raw depth file, or the sidecar of an FFV1 video.
+
+	Returns:
+		dict | None: {key: value}
+	"""
+
+	try:
+		if zipfile.is_zipfile(path):
+			with zipfile.ZipFile(path, "r") as zin:
+				metadata = zin.read("METADATA.txt").decode("utf-8")
+		elif os.path.exists(path + ".METADATA.txt"):
+			with open(path + ".METADATA.txt", "r", encoding="utf-8") as fin:
+				metadata = fin.read()
+		else:
+			metadata = RawDepthReader(path).metadata
+	except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+		return None
+
+	return dict(line.split('=', maxsplit=1) for line in metadata.split('\n') if '=' in line)
+
+def is_complete(path, isimage, frameformat="pgm") -> bool:
+	"""
+	Whether the output `path` has all of its frames.
+	The FFV1 & raw containers are moved into place only when the run completed (`close(commit=True)`), so they are complete if they exist.
+	A depthfile is complete if its checkpoint (or, if there is none, the number of the frame files) reaches the last frame
+	of its range (`range_*` in the metadata) within the framecount.
+	"""
+
+	if not os.path.exists(path):
+		return False
+	if not zipfile.is_zipfile(path):
+		return True
+
+	try:
+		with zipfile.ZipFile(path, "r") as zin:
+			namelist = zin.namelist()
+			if "METADATA.txt" not in namelist:
+				return False
+			if isimage:
+				return f"0.{frameformat}" in namelist
+
+			metadata = dict(line.split('=', maxsplit=1) for line in zin.read("METADATA.txt").decode("utf-8").split('\n') if '=' in line)
+			checkpoint = get_checkpoint(zin)
+			framecount = checkpoint["framecount"] if checkpoint is not None else int(metadata["framecount"])
+
+			#The frames the recorded range (`--start`, `--end` & `--stride` of depth.py) can reach
+			start = int(metadata.get("range_start", 0))
+			end = int(metadata.get("range_end", -1))
+			stride = int(metadata.get("range_stride", 1))
+			indices = range(start, min(end, framecount) if end >= 0 else framecount, stride)
+			if len(indices) == 0:
+				return True
+
+			if checkpoint is not None:
+				return checkpoint["lastframe"] >= indices[-1]
+			return len([name for name in namelist if name.endswith(f".{frameformat}")]) >= len(indices)
+	except (zipfile.BadZipFile, KeyError, ValueError):
+		return False
+
+def make_pgm(pixels, comment=None) -> bytes:
+	"""
+	Encode an uint8 or uint16 array as a P5 PGM, with an optional comment line after the magic number.
+	"""
+
+	height, width = pixels.shape[:2]
+	maxval = 255 if pixels.dtype == np.uint8 else 65535
+
+	header = "P5\n"
+	if comment is not None:
+		header += f"# {comment}\n"
+	header += f"{width} {height} {maxval}\n"
+
+	if pixels.dtype == np.uint16:
+		pixels = pixels.astype(">u2") #PGM is big-endian
+	return header.encode("ascii") + pixels.tobytes()
+
+def read_pgm(pgm):
+	"""
+	Decode a P5 PGM made by `make_pgm()` (or `Runner.get_pgm()`).
+
+	Returns:
+		(np.ndarray, str | None): the pixels (uint8 or uint16) & the comment
+	"""
+
+	pgm = memoryview(pgm)
+	fields = []
+	comment = None
+	pos = 0
+	while len(fields) < 4: #magic, width, height, maxval
+		end = bytes(pgm[pos:pos+80]).index(b"\n") + pos
+		line = bytes(pgm[pos:end]).decode("ascii")
+		pos = end + 1
+
+		if line.startswith("#"):
+			comment = line[1:].strip()
+		else:
+			fields += line.split()
+
+	magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+	if magic != "P5":
+		raise ValueError(f"Not a P5 PGM: {magic}")
+
+	dtype = np.uint8 if maxval <= 255 else np.dtype(">u2")
+	pixels = np.frombuffer(pgm, dtype=dtype, count=width*height, offset=pos).reshape(height, width)
+	if pixels.dtype != np.uint8:
+		pixels = pixels.astype(np.uint16) #native
+
+	return pixels, comment
+
+class DeltaEncoder():
+	"""
+	Encodes quantized frames as keyframes and residuals against the previously encoded frame.
+
+	Both are PGMs: a keyframe is a plain one, and a residual is `(cur - ref) mod (maxval + 1)`
+	with the comment `# ref=<index of ref>`. Consecutive depth maps are similar,
+	so the residuals are mostly near zero and deflate much better than the frames themselves.
+	Frames should be given in the order they are written.
+	"""
+
+	def __init__(self, keyframe_interval=30):
+		self.keyframe_interval = keyframe_interval
+		self.prev = None #(index, pixels)
+		self.since_keyframe = 0
+
+	def encode(self, index, pixels) -> bytes:
+		is_keyframe = (
+			self.prev is None
+			or self.prev[1].shape != pixels.shape
+			or self.prev[1].dtype != pixels.dtype
+			or self.since_keyframe + 1 >= self.keyframe_interval
+		)
+
+		if is_keyframe:
+			framefile = make_pgm(pixels)
+			self.since_keyframe = 0
+		else:
+			ref, ref_pixels = self.prev
+			framefile = make_pgm(pixels - ref_pixels, comment=f"ref={ref}") #wraps around
+			self.since_keyframe += 1
+
+		self.prev = (index, pixels)
+		return framefile
+
+class DeltaDecoder():
+	"""
+	Decodes the frames written by `DeltaEncoder` from `zin`.
+	Sequential reads cost one entry each; a random read costs at most `keyframe_interval` of them.
+	"""
+
+	def __init__(self, zin, frameformat):
+		self.zin = zin
+		self.frameformat = frameformat
+		self.prev = None #(index, pixels)
+
+	def read(self, index) -> np.ndarray:
+		#Walk back to the keyframe (or to the cached frame)
+		chain = []
+		i = index
+		while True:
+			if self.prev is not None and self.prev[0] == i:
+				pixels = self.prev[1]
+				break
+
+			pixels, comment = read_pgm(self.zin.read(f"{i}.{self.frameformat}"))
+			if comment is None or not comment.startswith("ref="):
+				break #keyframe
+
+			chain.append(pixels)
+			i = int(comment[len("ref="):])
+
+		for residual in reversed(chain):
+			pixels = pixels + residual #wraps around
+
+		self.prev = (index, pixels)
+		return pixels
+
+class DepthVideoWriter():
+	"""
+	Writes the quantized depth maps as a lossless grayscale FFV1 video in Matroska via FFmpeg (ffpyplayer),
+	so that long videos are stored & played sequentially as one stream rather than as one entry per frame.
+	The video is written to a temporary file and moved into place by `close()`, along with the files given to `writestr()`
+	(i.e. METADATA.txt as `<path>.METADATA.txt`), only if the run completed.
+	"""
+
+	def __init__(self, path, bits=8):
+		self.path = path
+		self.tmppath = path + ".tmp"
+		self.bits = bits
+		self.pix_fmt = "gray16le" if bits == 16 else "gray"
+		self.dtype = np.dtype("<u2") if bits == 16 else np.dtype(np.uint8)
+
+		self.writer = None
+		self.framerate = None
+		self.files = {} #{name: data}
+
+	def writestr(self, name, data, compresslevel=None):
+		#Same as `ZipFile.writestr()`, for `Runner.save_metadata()`
+		self.files[name] = data
+
+	def write(self, index, pixels, framerate):
+		"""
+		Args:
+			index (int): the frame index, which determines the timestamp
+			pixels (np.ndarray): uint8 (or uint16 for 16-bit) depth map
+			framerate (float): the framerate of the input. Only used for the first frame.
+		"""
+
+		from ffpyplayer.pic import Image
+
+		height, width = pixels.shape[:2]
+
+		if self.writer is None:
+			from ffpyplayer.writer import MediaWriter
+
+			self.framerate = framerate if framerate > 0 else 1
+			rate = Fraction(self.framerate).limit_denominator(1001)
+			stream = dict(
+				pix_fmt_in=self.pix_fmt,
+				width_in=width,
+				height_in=height,
+				codec="ffv1",
+				frame_rate=(rate.numerator, rate.denominator),
+			)
+			self.writer = MediaWriter(self.tmppath, [stream], fmt="matroska", overwrite=True)
+
+		img = Image(plane_buffers=[pixels.astype(self.dtype, copy=False).tobytes()], pix_fmt=self.pix_fmt, size=(width, height))
+		self.writer.write_frame(img=img, pts=index / self.framerate, stream=0)
+
+	def close(self, commit=True):
+		"""
+		Args:
+			commit (bool): If False (the run failed), the temporary file is deleted instead, so that an incomplete video is never in place.
+		"""
+
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+			if not commit:
+				os.remove(self.tmppath)
+				return
+			os.replace(self.tmppath, self.path)
+		elif not commit:
+			return
+
+		for name, data in self.files.items():
+			mode = "w" if isinstance(data, str) else "wb"
+			with open(f"{self.path}.{name}", mode) as fout:
+				fout.write(data)
+
+class RawDepthWriter():
+	"""
+	Writes the depth maps of a video as one fixed-stride array file, so that a reader can `np.memmap()` it
+	and get frame #N as a view, without unzipping or parsing (see `RawDepthReader`).
+
+	Layout: a `RAW_HEADER_SIZE`-byte text header padded with NULs, then the frames (little-endian, C order),
+	frame #i in the slot `(i - start) // stride`, at `RAW_HEADER_SIZE + slot * height * width * itemsize`. Missing frames are zeros.
+	The header is
+		DEPTHVIEWER_RAW
+		dtype=<numpy dtype str>
+		width=..., height=..., framecount=..., start=..., stride=... (one per line; framecount is the number of slots)
+		(empty line)
+		(METADATA.txt)
+	and is written on `close()`, since the shape & the metadata are not known beforehand.
+	Like `DepthVideoWriter`, the file is written to a temporary file and moved into place by `close()` if the run completed.
+	"""
+
+	def __init__(self, path, dtype=np.uint8, start=0, stride=1, flush_every=64):
+		self.path = path
+		self.start = start
+		self.stride = stride
+		self.tmppath = path + ".tmp"
+		self.dtype = np.dtype(dtype).newbyteorder('<')
+		self.flush_every = flush_every
+
+		self.fout = open(self.tmppath, "wb")
+		self.fout.write(bytes(RAW_HEADER_SIZE)) #placeholder
+
+		self.shape = None
+		self.framecount = 0 #max. slot + 1
+		self.written = 0
+		self.metadata = ""
+
+	def writestr(self, name, data, compresslevel=None):
+		#Same as `ZipFile.writestr()`, for `Runner.save_metadata()`
+		if name != "METADATA.txt":
+			raise ValueError(f"Can't store {name} in a raw depth file")
+		self.metadata = data.decode("utf-8") if isinstance(data, bytes) else data
+
+	def write(self, index, pixels, framerate=None):
+		pixels = np.ascontiguousarray(pixels, dtype=self.dtype)
+		if self.shape is None:
+			self.shape = pixels.shape[:2]
+		elif pixels.shape[:2] != self.shape:
+			raise ValueError(f"Frame #{index} has the shape {pixels.shape[:2]}, expected {self.shape}")
+
+		slot = (index - self.start) // self.stride
+		self.fout.seek(RAW_HEADER_SIZE + slot * pixels.nbytes)
+		self.fout.write(memoryview(pixels).cast('B'))
+		self.framecount = max(self.framecount, slot + 1)
+
+		#Write out in chunks, so that the memory use does not grow with the file
+		self.written += 1
+		if self.written % self.flush_every == 0:
+			self.fout.flush()
+
+	def get_header(self) -> bytes:
+		height, width = self.shape if self.shape is not None else (0, 0)
+		header = '\n'.join([
+			"DEPTHVIEWER_RAW",
+			f"dtype={self.dtype.str}",
+			f"width={width}",
+			f"height={height}",
+			f"framecount={self.framecount}",
+			f"start={self.start}",
+			f"stride={self.stride}",
+			"",
+			self.metadata,
+		]).encode("utf-8")
+
+		if len(header) > RAW_HEADER_SIZE:
+			raise ValueError(f"The header is too long: {len(header)} > {RAW_HEADER_SIZE}")
+		return header + bytes(RAW_HEADER_SIZE - len(header))
+
+	def close(self, commit=True):
+		"""
+		Args:
+			commit (bool): If False (the run failed), the temporary file is deleted instead, so that an incomplete file is never in place.
+		"""
+
+		if self.fout is None:
+			return
+
+		if not commit:
+			self.fout.close()
+			self.fout = None
+			os.remove(self.tmppath)
+			return
+
+		#Pad the missing trailing frames (if any) so that the size matches the header
+		if self.shape is not None:
+			self.fout.truncate(RAW_HEADER_SIZE + self.framecount * self.shape[0] * self.shape[1] * self.dtype.itemsize)
+
+		self.fout.seek(0)
+		self.fout.write(self.get_header())
+		self.fout.close()
+		self.fout = None
+
+		os.replace(self.tmppath, self.path)
+
+class RawDepthReader():
+	"""
+	Reads a file written by `RawDepthWriter` through `np.memmap()`.
+	`read(i)` is frame #i of the video as a read-only view of the file; `frames` holds the slots.
+	"""
+
+	def __init__(self, path):
+		with open(path, "rb") as fin:
+			header = fin.read(RAW_HEADER_SIZE).rstrip(b"\0").decode("utf-8")
+
+		lines = header.split('\n')
+		if lines[0] != "DEPTHVIEWER_RAW":
+			raise ValueError(f"Not a raw depth file: {path}")
+
+		fields = {}
+		for i, line in enumerate(lines[1:], start=1):
+			if line == "":
+				break
+			k, v = line.split('=', maxsplit=1)
+			fields[k] = v
+		self.metadata = '\n'.join(lines[i+1:])
+
+		self.dtype = np.dtype(fields["dtype"])
+		self.width = int(fields["width"])
+		self.height = int(fields["height"])
+		self.framecount = int(fields["framecount"])
+		self.start = int(fields.get("start", 0))
+		self.stride = int(fields.get("stride", 1))
+
+		if self.framecount > 0:
+			self.frames = np.memmap(path, dtype=self.dtype, mode="r", offset=RAW_HEADER_SIZE, shape=(self.framecount, self.height, self.width))
+		else:
+			self.frames = np.empty((0, self.height, self.width), dtype=self.dtype)
+
+	def read(self, index) -> np.ndarray:
+		slot, rem = divmod(index - self.start, self.stride)
+		if rem != 0 or not 0 <= slot < self.framecount:
+			raise IndexError(f"Frame #{index} is not in the file")
+		return self.frames[slot]
+
+	def __len__(self):
+		return self.framecount
@@ -107,7 +107,7 @@ if __name__ == "__main__":
 	runner = depth.get_loaded_runner(args)
 
 	print("depthmq: Preparing the model. This may take some time.")
-	dummy = np.zeros((512, 512, 3), dtype=np.float32)
+	dummy = np.zeros((512, 512, 3), dtype=np.uint8)
 	runner.run_frame(dummy)
 	print("depthmq: Done.")
 
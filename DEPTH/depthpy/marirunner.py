@@ -129,7 +129,9 @@ class MariRunner(Runner):
 		self.model = pipe
 
 	def run_frame(self, img):
-		pil_image = Image.fromarray(np.uint8(img * 255)).convert("RGB")
+		if img.dtype != np.uint8:
+			img = np.uint8(img * 255)
+		pil_image = Image.fromarray(img).convert("RGB")
 		#pil_image.show()
 
 		# Predict depth
@@ -1,16 +1,36 @@
 import timm
 import torch
 import types
+import collections
 
-import numpy as np
 import torch.nn.functional as F
 
-from .utils import forward_adapted_unflatten, make_backbone_default
+from .utils import forward_adapted_unflatten, is_tracing, make_backbone_default
 from timm.models.beit import gen_relative_position_index
 from torch.utils.checkpoint import checkpoint
 from typing import Optional
 
 
+# Max. total size (MiB) of the relative position biases cached per model (see `_get_rel_pos_bias`).
+# A bias is heads * (h*w/256 + 1)^2 float32s per block for an h*w input: all the blocks of beitb16_384 take 183 MiB
+# at 384x384 & 577 MiB at 512x512, those of beitl16_512 take 1.5 GiB at 512x512, so only some blocks are cached.
+REL_POS_BIAS_CACHE_MIB = 256
+
+# Use `F.scaled_dot_product_attention` in `attention_forward` (see `set_sdpa`)
+USE_SDPA = False
+
+
+def set_sdpa(enabled):
+    """
+    Routes the attentions through `F.scaled_dot_product_attention` (with the relative position bias as the additive
+    mask), which does not materialize the attention matrix when a fused kernel is available.
+    Returns whether it is used (it needs torch>=2.0).
+    """
+    global USE_SDPA
+    USE_SDPA = enabled and hasattr(F, "scaled_dot_product_attention")
+    return USE_SDPA
+
+
 def forward_beit(pretrained, x):
     return forward_adapted_unflatten(pretrained, x, "forward_features")
 
@@ -26,10 +46,61 @@ def patch_embed_forward(self, x):
     return x
 
 
+def set_rel_pos_bias_cache(mib):
+    """
+    Sets the max. total size (MiB) of the cached relative position biases per model (`REL_POS_BIAS_CACHE_MIB`).
+    0 disables the cache. Takes effect on the next forward.
+    """
+    global REL_POS_BIAS_CACHE_MIB
+    REL_POS_BIAS_CACHE_MIB = mib
+
+
 def _get_rel_pos_bias(self, window_size):
     """
     Modification of timm.models.beit.py: Attention._get_rel_pos_bias to support arbitrary window sizes.
+    Without grad (and outside of tracing & compiling), the result is cached in the cache shared by the blocks of the
+    model, per block, window size and the dtype, device & version of the table (so it is recomputed after the table
+    is converted or modified in-place). See `_cache_rel_pos_bias`.
     """
+    table = self.relative_position_bias_table
+    cacheable = not torch.is_grad_enabled() and not is_tracing() and REL_POS_BIAS_CACHE_MIB > 0
+    if cacheable:
+        cache_key = (self.block_index, tuple(int(x) for x in window_size), table.dtype, table.device, table._version)
+        relative_position_bias = self.relative_position_biases.get(cache_key)
+        if relative_position_bias is not None:
+            self.relative_position_biases.move_to_end(cache_key)
+            return relative_position_bias
+
+    relative_position_bias = _compute_rel_pos_bias(self, window_size)
+
+    if cacheable:
+        _cache_rel_pos_bias(self.relative_position_biases, cache_key, relative_position_bias)
+    return relative_position_bias
+
+
+def _cache_rel_pos_bias(cache, cache_key, relative_position_bias):
+    """
+    Adds the bias to `cache`, keeping the total size within `REL_POS_BIAS_CACHE_MIB`. The least recently used entries
+    are evicted first, except those of the other blocks for the same window size, dtype & device: the blocks are run
+    in turn, so evicting them would make every block miss. If it still does not fit, the bias is not cached.
+    """
+    budget = REL_POS_BIAS_CACHE_MIB * 1024**2
+    nbytes = lambda t: t.numel() * t.element_size()
+
+    used = sum(nbytes(t) for t in cache.values())
+    needed = nbytes(relative_position_bias)
+    for key in list(cache):
+        if used + needed <= budget:
+            break
+        if key[0] != cache_key[0] and key[1:4] == cache_key[1:4]:
+            continue
+        used -= nbytes(cache.pop(key))
+
+    if used + needed <= budget:
+        cache[cache_key] = relative_position_bias
+
+
+def _compute_rel_pos_bias(self, window_size):
     old_height = 2 * self.window_size[0] - 1
     old_width = 2 * self.window_size[1] - 1
 
@@ -73,19 +144,34 @@ def attention_forward(self, x, resolution, shared_rel_pos_bias: Optional[torch.T
     qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
     q, k, v = qkv.unbind(0)  # make torchscript happy (cannot use tensor as tuple)
 
-    q = q * self.scale
-    attn = (q @ k.transpose(-2, -1))
-
+    rel_pos_bias = None
     if self.relative_position_bias_table is not None:
-        window_size = tuple(np.array(resolution) // 16)
-        attn = attn + self._get_rel_pos_bias(window_size)
-    if shared_rel_pos_bias is not None:
-        attn = attn + shared_rel_pos_bias
+        window_size = (resolution[0] // 16, resolution[1] // 16)
+        rel_pos_bias = self._get_rel_pos_bias(window_size)
+
+    if USE_SDPA:
+        attn_mask = rel_pos_bias
+        if shared_rel_pos_bias is not None:
+            attn_mask = shared_rel_pos_bias if attn_mask is None else attn_mask + shared_rel_pos_bias
+
+        # The default scale of SDPA is head_dim ** -0.5, same as self.scale
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                           dropout_p=self.attn_drop.p if self.training else 0.0)
+    else:
+        q = q * self.scale
+        attn = (q @ k.transpose(-2, -1))
+
+        if rel_pos_bias is not None:
+            attn = attn + rel_pos_bias
+        if shared_rel_pos_bias is not None:
+            attn = attn + shared_rel_pos_bias
+
+        attn = attn.softmax(dim=-1)
+        attn = self.attn_drop(attn)
 
-    attn = attn.softmax(dim=-1)
-    attn = self.attn_drop(attn)
+        x = attn @ v
 
-    x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+    x = x.transpose(1, 2).reshape(B, N, -1)
     x = self.proj(x)
     x = self.proj_drop(x)
     return x
@@ -143,11 +229,14 @@ def _make_beit_backbone(
     backbone.model.patch_embed.forward = types.MethodType(patch_embed_forward, backbone.model.patch_embed)
     backbone.model.forward_features = types.MethodType(beit_forward_features, backbone.model)
 
-    for block in backbone.model.blocks:
+    relative_position_biases = collections.OrderedDict()  # shared by the blocks, see `_get_rel_pos_bias`
+    for block_index, block in enumerate(backbone.model.blocks):
         attn = block.attn
         attn._get_rel_pos_bias = types.MethodType(_get_rel_pos_bias, attn)
         attn.forward = types.MethodType(attention_forward, attn)
         attn.relative_position_indices = {}
+        attn.relative_position_biases = relative_position_biases
+        attn.block_index = block_index
 
         block.forward = types.MethodType(block_forward, block)
 
@@ -50,6 +50,18 @@ class Transpose(nn.Module):
         return x
 
 
+def is_tracing():
+    """
+    Whether the model is being traced (`torch.jit.trace`, ONNX export) or compiled (`torch.compile`),
+    when the Python-side caches must be bypassed.
+    """
+    if torch.jit.is_tracing():
+        return True
+
+    is_compiling = getattr(getattr(torch, "compiler", None), "is_compiling", None)
+    return is_compiling is not None and is_compiling()
+
+
 activations = {}
 
 
@@ -61,7 +73,7 @@ def get_activation(name):
 
 
 def forward_default(pretrained, x, function_name="forward_features"):
-    exec(f"pretrained.model.{function_name}(x)")
+    getattr(pretrained.model, function_name)(x)
 
     layer_1 = pretrained.activations["1"]
     layer_2 = pretrained.activations["2"]
@@ -80,46 +92,46 @@ def forward_default(pretrained, x, function_name="forward_features"):
     return layer_1, layer_2, layer_3, layer_4
 
 
+def forward_layers(sequential, x, start, end=None):
+    """
+    Same as `sequential[start:end](x)`, without building a new `nn.Sequential` per call.
+    """
+    for layer in list(sequential)[start:end]:
+        x = layer(x)
+    return x
+
+
 def forward_adapted_unflatten(pretrained, x, function_name="forward_features"):
     b, c, h, w = x.shape
 
-    exec(f"glob = pretrained.model.{function_name}(x)")
+    getattr(pretrained.model, function_name)(x)
 
     layer_1 = pretrained.activations["1"]
     layer_2 = pretrained.activations["2"]
     layer_3 = pretrained.activations["3"]
     layer_4 = pretrained.activations["4"]
 
-    layer_1 = pretrained.act_postprocess1[0:2](layer_1)
-    layer_2 = pretrained.act_postprocess2[0:2](layer_2)
-    layer_3 = pretrained.act_postprocess3[0:2](layer_3)
-    layer_4 = pretrained.act_postprocess4[0:2](layer_4)
-
-    unflatten = nn.Sequential(
-        nn.Unflatten(
-            2,
-            torch.Size(
-                [
-                    h // pretrained.model.patch_size[1],
-                    w // pretrained.model.patch_size[0],
-                ]
-            ),
-        )
-    )
+    layer_1 = forward_layers(pretrained.act_postprocess1, layer_1, 0, 2)
+    layer_2 = forward_layers(pretrained.act_postprocess2, layer_2, 0, 2)
+    layer_3 = forward_layers(pretrained.act_postprocess3, layer_3, 0, 2)
+    layer_4 = forward_layers(pretrained.act_postprocess4, layer_4, 0, 2)
+
+    # The Unflatten of act_postprocess* (index 2) is for the training size, so unflatten to the grid of this input instead
+    grid_size = (h // pretrained.model.patch_size[1], w // pretrained.model.patch_size[0])
 
     if layer_1.ndim == 3:
-        layer_1 = unflatten(layer_1)
+        layer_1 = layer_1.unflatten(2, grid_size)
     if layer_2.ndim == 3:
-        layer_2 = unflatten(layer_2)
+        layer_2 = layer_2.unflatten(2, grid_size)
     if layer_3.ndim == 3:
-        layer_3 = unflatten(layer_3)
+        layer_3 = layer_3.unflatten(2, grid_size)
     if layer_4.ndim == 3:
-        layer_4 = unflatten(layer_4)
+        layer_4 = layer_4.unflatten(2, grid_size)
 
-    layer_1 = pretrained.act_postprocess1[3: len(pretrained.act_postprocess1)](layer_1)
-    layer_2 = pretrained.act_postprocess2[3: len(pretrained.act_postprocess2)](layer_2)
-    layer_3 = pretrained.act_postprocess3[3: len(pretrained.act_postprocess3)](layer_3)
-    layer_4 = pretrained.act_postprocess4[3: len(pretrained.act_postprocess4)](layer_4)
+    layer_1 = forward_layers(pretrained.act_postprocess1, layer_1, 3)
+    layer_2 = forward_layers(pretrained.act_postprocess2, layer_2, 3)
+    layer_3 = forward_layers(pretrained.act_postprocess3, layer_3, 3)
+    layer_4 = forward_layers(pretrained.act_postprocess4, layer_4, 3)
 
     return layer_1, layer_2, layer_3, layer_4
 
@@ -3,17 +3,45 @@ import torch.nn as nn
 import timm
 import types
 import math
+import collections
 import torch.nn.functional as F
 
-from .utils import (activations, forward_adapted_unflatten, get_activation, get_readout_oper,
+from .utils import (activations, forward_adapted_unflatten, get_activation, get_readout_oper, is_tracing,
                     make_backbone_default, Transpose)
 
 
+# Max. number of the resized position embeddings cached per model (see `_resize_pos_embed`)
+POS_EMBED_CACHE_SIZE = 4
+
+
 def forward_vit(pretrained, x):
     return forward_adapted_unflatten(pretrained, x, "forward_flex")
 
 
 def _resize_pos_embed(self, posemb, gs_h, gs_w):
+    """
+    Without grad (and outside of tracing & compiling), the result is cached per grid size and the dtype, device &
+    version of `posemb` (so it is recomputed after the embedding is converted or modified in-place), keeping the
+    `POS_EMBED_CACHE_SIZE` most recently used ones.
+    """
+    cacheable = not torch.is_grad_enabled() and not is_tracing() and POS_EMBED_CACHE_SIZE > 0
+    if cacheable:
+        cache_key = (int(gs_h), int(gs_w), posemb.dtype, posemb.device, posemb._version)
+        resized = self.resized_pos_embeds.get(cache_key)
+        if resized is not None:
+            self.resized_pos_embeds.move_to_end(cache_key)
+            return resized
+
+    resized = _compute_resized_pos_embed(self, posemb, gs_h, gs_w)
+
+    if cacheable:
+        self.resized_pos_embeds[cache_key] = resized
+        while len(self.resized_pos_embeds) > POS_EMBED_CACHE_SIZE:
+            self.resized_pos_embeds.popitem(last=False)
+    return resized
+
+
+def _compute_resized_pos_embed(self, posemb, gs_h, gs_w):
     posemb_tok, posemb_grid = (
         posemb[:, : self.start_index],
         posemb[0, self.start_index:],
@@ -91,6 +119,7 @@ def _make_vit_b16_backbone(
     pretrained.model._resize_pos_embed = types.MethodType(
         _resize_pos_embed, pretrained.model
     )
+    pretrained.model.resized_pos_embeds = collections.OrderedDict()
 
     return pretrained
 
@@ -147,7 +176,7 @@ def _make_vit_b_rn50_backbone(
 
     for s in range(used_number_stages):
         value = nn.Sequential(nn.Identity(), nn.Identity(), nn.Identity())
-        exec(f"pretrained.act_postprocess{s + 1}=value")
+        setattr(pretrained, f"act_postprocess{s + 1}", value)
     for s in range(used_number_stages, 4):
         if s < number_stages:
             final_layer = nn.ConvTranspose2d(
@@ -187,7 +216,7 @@ def _make_vit_b_rn50_backbone(
             layers.append(final_layer)
 
         value = nn.Sequential(*layers)
-        exec(f"pretrained.act_postprocess{s + 1}=value")
+        setattr(pretrained, f"act_postprocess{s + 1}", value)
 
     pretrained.model.start_index = start_index
     pretrained.model.patch_size = patch_size
@@ -201,6 +230,7 @@ def _make_vit_b_rn50_backbone(
     pretrained.model._resize_pos_embed = types.MethodType(
         _resize_pos_embed, pretrained.model
     )
+    pretrained.model.resized_pos_embeds = collections.OrderedDict()
 
     return pretrained
 
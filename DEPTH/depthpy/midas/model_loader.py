@@ -4,7 +4,7 @@ import torch
 from midas.dpt_depth import DPTDepthModel
 from midas.midas_net import MidasNet
 from midas.midas_net_custom import MidasNet_small
-from midas.transforms import Resize, NormalizeImage, PrepareForNet
+from midas.transforms import Resize, ToFloatImage, NormalizeImage, PrepareForNet
 
 from torchvision.transforms import Compose
 
@@ -248,6 +248,7 @@ def load_model(device, model_path, model_type="dpt_large_384", optimize=True, he
 
     transform = Compose(
         [
+            ToFloatImage(),  # before the cubic resize, whose overshoot would be clamped in uint8
             Resize(
                 net_w,
                 net_h,
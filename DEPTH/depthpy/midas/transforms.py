@@ -1,6 +1,8 @@
 import numpy as np
 import cv2
 import math
+import torch
+import torch.nn.functional as F
 
 
 def apply_min_size(sample, size, image_interpolation_method=cv2.INTER_AREA):
@@ -159,6 +161,10 @@ class Resize(object):
 
         return (new_width, new_height)
 
+    @property
+    def image_interpolation_method(self):
+        return self.__image_interpolation_method
+
     def __call__(self, sample):
         width, height = self.get_size(
             sample["image"].shape[1], sample["image"].shape[0]
@@ -194,13 +200,42 @@ class Resize(object):
         return sample
 
 
+class ToFloatImage(object):
+    """Convert an uint8 image to float32 in [0, 1]. Other images are cast to float32.
+
+    Placed before a cubic (or Lanczos) Resize, since its overshoot would be clamped in uint8,
+    and after the other ones so that they resize the (smaller) uint8 image.
+    """
+
+    def __init__(self):
+        pass
+
+    def __call__(self, sample):
+        image = sample["image"]
+        if image.dtype == np.uint8:
+            sample["image"] = image.astype(np.float32) * np.float32(1 / 255)
+        else:
+            sample["image"] = image.astype(np.float32, copy=False)
+
+        return sample
+
+
 class NormalizeImage(object):
     """Normlize image by given mean and std.
     """
 
     def __init__(self, mean, std):
-        self.__mean = mean
-        self.__std = std
+        # float32, so that float32 images are not promoted to float64
+        self.__mean = np.asarray(mean, dtype=np.float32)
+        self.__std = np.asarray(std, dtype=np.float32)
+
+    @property
+    def mean(self):
+        return self.__mean
+
+    @property
+    def std(self):
+        return self.__std
 
     def __call__(self, sample):
         sample["image"] = (sample["image"] - self.__mean) / self.__std
@@ -232,3 +267,195 @@ class PrepareForNet(object):
             sample["depth"] = np.ascontiguousarray(depth)
 
         return sample
+
+
+class PrepareBatchForNet(object):
+    """Batched equivalent of Resize -> NormalizeImage -> PrepareForNet for the images only.
+
+    Each image is resized into a preallocated float32 (B, H, W, 3) buffer, then the whole batch is
+    normalized and transposed into a preallocated float32 (B, 3, H, W) array at once.
+    """
+
+    def __init__(self, resize, normalization=None):
+        """Init.
+
+        Args:
+            resize (Resize): the resize transform to get the size & the interpolation method from
+            normalization (NormalizeImage, optional): the normalization to apply. Defaults to None.
+        """
+        self.__resize = resize
+
+        if normalization is not None:
+            self.__mean = np.asarray(normalization.mean, dtype=np.float32)
+            self.__std = np.asarray(normalization.std, dtype=np.float32)
+        else:
+            self.__mean = self.__std = None
+
+        self.__hwc = None
+        self.__chw = None
+
+    @staticmethod
+    def from_compose(transform):
+        """Build from a Compose of Resize, NormalizeImage (optional) and PrepareForNet.
+
+        Returns:
+            PrepareBatchForNet: None if `transform` is not of that form
+        """
+        transforms = getattr(transform, "transforms", None)
+        if transforms is None or not any(isinstance(t, PrepareForNet) for t in transforms):
+            return None
+        if not all(isinstance(t, (Resize, ToFloatImage, NormalizeImage, PrepareForNet)) for t in transforms):
+            return None
+
+        resize = [t for t in transforms if isinstance(t, Resize)]
+        normalization = [t for t in transforms if isinstance(t, NormalizeImage)]
+        if len(resize) != 1 or len(normalization) > 1:
+            return None
+
+        return PrepareBatchForNet(resize[0], normalization[0] if normalization else None)
+
+    def get_size(self, image):
+        return self.__resize.get_size(image.shape[1], image.shape[0])
+
+    def __call__(self, images, batch_size=None, pad_to=None):
+        """
+        Args:
+            images (list): images (uint8 in [0, 255] or float in [0, 1]) of the same size. The size after resizing should be the same.
+            batch_size (int, optional): pad the batch with zeros up to this size. Defaults to len(images).
+            pad_to (tuple, optional): (width, height) to pad each resized image to (at the bottom & right, with zeros after the normalization).
+                With this, the images may be of different sizes as long as they fit in it. Defaults to None.
+
+        Returns:
+            np.ndarray: float32 array of shape (batch_size, 3, H, W). This is reused by the next call.
+        """
+        n = len(images)
+        batch_size = n if batch_size is None else batch_size
+
+        width, height = self.get_size(images[0]) if pad_to is None else pad_to
+        if self.__hwc is None or self.__hwc.shape != (batch_size, height, width, 3):
+            self.__hwc = np.empty((batch_size, height, width, 3), dtype=np.float32)
+            self.__chw = np.empty((batch_size, 3, height, width), dtype=np.float32)
+        hwc, chw = self.__hwc, self.__chw
+
+        sizes = [self.get_size(image) for image in images]
+        for i, (image, (w, h)) in enumerate(zip(images, sizes)):
+            if (pad_to is None and (w, h) != (width, height)) or w > width or h > height:
+                raise ValueError(f"Expected images resized to {(width, height)}, got {(w, h)}")
+
+            if (w, h) != (width, height):
+                hwc[i, h:] = 0
+                hwc[i, :h, w:] = 0
+            if image.dtype == np.uint8 and self.__resize.image_interpolation_method in [cv2.INTER_CUBIC, cv2.INTER_LANCZOS4]:
+                image = image.astype(np.float32)  # the overshoot would be clamped in uint8 (scaled below)
+            hwc[i, :h, :w] = cv2.resize(
+                image, (w, h), interpolation=self.__resize.image_interpolation_method
+            )
+
+        if images[0].dtype == np.uint8:
+            np.multiply(hwc[:n], np.float32(1 / 255), out=hwc[:n])
+
+        if self.__mean is not None:
+            np.subtract(hwc[:n], self.__mean, out=hwc[:n])
+            np.divide(hwc[:n], self.__std, out=hwc[:n])
+
+        np.copyto(chw[:n], hwc[:n].transpose(0, 3, 1, 2))
+        chw[n:] = 0 # padding
+
+        for i, (w, h) in enumerate(sizes):
+            if (w, h) != (width, height):
+                chw[i, :, h:] = 0
+                chw[i, :, :h, w:] = 0
+
+        return chw
+
+
+class PrepareBatchOnDevice(object):
+    """Resize -> NormalizeImage -> PrepareForNet as tensor ops on the target device.
+
+    The images are uploaded as they are (i.e. uint8 frames are not converted on the host),
+    then converted to float32, resized, normalized and laid out as (B, 3, H, W) on the device.
+    """
+
+    interpolation_modes = {
+        cv2.INTER_NEAREST: "nearest",
+        cv2.INTER_LINEAR: "bilinear",
+        cv2.INTER_CUBIC: "bicubic",
+        cv2.INTER_AREA: "area",
+    }
+
+    def __init__(self, resize, normalization, device):
+        """Init.
+
+        Args:
+            resize (Resize): the resize transform to get the size & the interpolation method from
+            normalization (NormalizeImage | None): the normalization to apply
+            device (torch.device): the device to run on
+        """
+        self.__resize = resize
+        self.__mode = self.interpolation_modes.get(resize.image_interpolation_method, "bicubic")
+        self.__device = device
+
+        if normalization is not None:
+            self.__mean = torch.tensor(normalization.mean, dtype=torch.float32, device=device).view(1, 3, 1, 1)
+            self.__std = torch.tensor(normalization.std, dtype=torch.float32, device=device).view(1, 3, 1, 1)
+        else:
+            self.__mean = self.__std = None
+
+    @staticmethod
+    def from_compose(transform, device):
+        """Build from a Compose of Resize, NormalizeImage (optional) and PrepareForNet.
+
+        Returns:
+            PrepareBatchOnDevice: None if `transform` is not of that form
+        """
+        batch_transform = PrepareBatchForNet.from_compose(transform)
+        if batch_transform is None:
+            return None
+
+        transforms = transform.transforms
+        resize = [t for t in transforms if isinstance(t, Resize)][0]
+        normalization = [t for t in transforms if isinstance(t, NormalizeImage)]
+
+        return PrepareBatchOnDevice(resize, normalization[0] if normalization else None, device)
+
+    def __call__(self, images, batch_size=None):
+        """
+        Args:
+            images (list): images (uint8 in [0, 255] or float in [0, 1]) of the same size
+            batch_size (int, optional): pad the batch with zeros up to this size. Defaults to len(images).
+
+        Returns:
+            torch.Tensor: float32 tensor of shape (batch_size, 3, H, W) on the device
+        """
+        n = len(images)
+        batch_size = n if batch_size is None else batch_size
+
+        height, width = images[0].shape[:2]
+        for image in images:
+            if image.shape[:2] != (height, width):
+                raise ValueError(f"Expected images of size {(width, height)}, got {image.shape[1::-1]}")
+        new_width, new_height = self.__resize.get_size(width, height)
+
+        batch = images[0][None] if n == 1 else np.stack(images)
+        is_uint8 = batch.dtype == np.uint8
+
+        # upload as is, then convert on the device
+        batch = torch.from_numpy(np.ascontiguousarray(batch)).to(self.__device)
+        batch = batch.permute(0, 3, 1, 2).float()
+        if is_uint8:
+            batch = batch.mul_(1 / 255)
+
+        if (new_height, new_width) != (height, width):
+            if self.__mode in ["bilinear", "bicubic"]:
+                batch = F.interpolate(batch, size=(new_height, new_width), mode=self.__mode, align_corners=False)
+            else:
+                batch = F.interpolate(batch, size=(new_height, new_width), mode=self.__mode)
+
+        if self.__mean is not None:
+            batch = batch.sub_(self.__mean).div_(self.__std)
+
+        if batch_size > n:
+            padding = batch.new_zeros((batch_size - n, 3, new_height, new_width))
+            batch = torch.cat([batch, padding])
+
+        return batch.contiguous()
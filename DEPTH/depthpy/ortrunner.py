@@ -1,6 +1,6 @@
 from depth import Runner
 
-from midas.transforms import Resize, NormalizeImage, PrepareForNet
+from midas.transforms import Resize, ToFloatImage, NormalizeImage, PrepareForNet
 
 from torchvision.transforms import Compose
 import cv2
@@ -57,6 +57,7 @@ class OrtRunner(Runner):
 			#From model_loader.py
 			transform = Compose(
 				[
+					ToFloatImage(), #before the cubic resize, whose overshoot would be clamped in uint8
 					Resize(
 						net_w,
 						net_h,
@@ -74,8 +75,8 @@ class OrtRunner(Runner):
 		else:
 			#From run_onnx.py
 
-			def compose2(f1, f2):
-				return lambda x: f2(f1(x))
+			def compose3(f1, f2, f3):
+				return lambda x: f3(f2(f1(x)))
 
 			resize_image = Resize(
 				net_w,
@@ -87,6 +88,6 @@ class OrtRunner(Runner):
 				image_interpolation_method=cv2.INTER_CUBIC,
 			)
 
-			transform = compose2(resize_image, PrepareForNet())
+			transform = compose3(ToFloatImage(), resize_image, PrepareForNet()) #float32 before the cubic resize
 
 		return transform
\ No newline at end of file
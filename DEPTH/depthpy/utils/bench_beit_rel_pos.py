@@ -0,0 +1,57 @@
+import argparse
+
+import torch
+
+from bench_common import get_device, make_model, set_rel_pos_bias_cache, measure
+import midas.backbones.beit as beit
+
+"""
+Compares the frames/s of the DPT-BEiT models with & without the cache of the relative position biases
+(`midas.backbones.beit.REL_POS_BIAS_CACHE_MIB`), and checks that the outputs are the same.
+"""
+
+def get_cached(model):
+	#(number of the cached blocks, MiB)
+	biases = model.pretrained.model.blocks[0].attn.relative_position_biases.values()
+	return len(biases), sum(t.numel() * t.element_size() for t in biases) / 1024**2
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--backbone",
+		help="defaults to beitb16_384 (the large ones take seconds per frame on CPU)",
+		default="beitb16_384",
+		choices=["beitl16_512", "beitl16_384", "beitb16_384"],
+	)
+	parser.add_argument("--height",
+		type=int, default=384,
+	)
+	parser.add_argument("--width",
+		type=int, default=512,
+	)
+	parser.add_argument("--cache_mib",
+		help="the cache size to compare (defaults to `REL_POS_BIAS_CACHE_MIB`)",
+		type=int, default=beit.REL_POS_BIAS_CACHE_MIB,
+	)
+	parser.add_argument("--runs",
+		help="number of runs per measurement",
+		type=int, default=5,
+	)
+	args = parser.parse_args()
+
+	device = get_device()
+	print(f"device: {device}")
+
+	model = make_model(args.backbone, device)
+	x = torch.randn(1, 3, args.height, args.width, device=device)
+	print(f"{args.backbone}, {args.width}x{args.height}")
+
+	set_rel_pos_bias_cache(model, 0)
+	old_time, old_out = measure(model, x, args.runs)
+
+	set_rel_pos_bias_cache(model, args.cache_mib)
+	new_time, new_out = measure(model, x, args.runs)
+	blocks, mib = get_cached(model)
+
+	print(f"\tuncached: {1 / old_time :.3f} frames/s ({old_time * 1000 :.1f}ms)")
+	print(f"\tcached:   {1 / new_time :.3f} frames/s ({new_time * 1000 :.1f}ms), {blocks}/{len(model.pretrained.model.blocks)} blocks cached in {mib :.1f}MiB (of {args.cache_mib}MiB)")
+	print(f"\t-> x{old_time / new_time :.3f}, max. abs. diff of the outputs: {(old_out - new_out).abs().max().item()}")
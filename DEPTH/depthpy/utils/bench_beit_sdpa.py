@@ -0,0 +1,94 @@
+import sys
+import argparse
+import multiprocessing
+
+import torch
+
+from bench_common import get_device, make_model, measure, get_max_rss
+import midas.backbones.beit as beit
+
+"""
+Compares the explicit attention of the DPT-BEiT models with `F.scaled_dot_product_attention` (`beit.set_sdpa()`):
+latency, peak memory and the difference of the outputs.
+Each mode runs in its own process so that the peak memory is its own: allocated on CUDA, the max. RSS on CPU
+(POSIX only; elsewhere the memory is not reported).
+"""
+
+def run_mode(args, sdpa, conn):
+	if args.threads:
+		torch.set_num_threads(args.threads)
+	device = get_device()
+
+	beit.set_sdpa(sdpa)
+
+	torch.manual_seed(0)
+	model = make_model(args.backbone, device)
+	x = torch.randn(1, 3, args.height, args.width, device=device)
+
+	if device.type == "cuda":
+		torch.cuda.reset_peak_memory_stats()
+	base_rss = get_max_rss()
+
+	median_time, out = measure(model, x, args.runs)
+
+	if device.type == "cuda":
+		peak = torch.cuda.max_memory_allocated() / 1024**2
+	elif base_rss is not None:
+		peak = get_max_rss() - base_rss #the growth over the loaded model
+	else:
+		peak = None
+
+	conn.send((str(device), median_time, peak, out.cpu()))
+	conn.close()
+
+def run(args, sdpa):
+	ctx = multiprocessing.get_context("spawn")
+	parent_conn, child_conn = ctx.Pipe()
+	p = ctx.Process(target=run_mode, args=(args, sdpa, child_conn))
+	p.start()
+	result = parent_conn.recv()
+	p.join()
+	return result
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--backbone",
+		help="defaults to beitb16_384 (the large ones take seconds per frame on CPU)",
+		default="beitb16_384",
+		choices=["beitl16_512", "beitl16_384", "beitb16_384"],
+	)
+	parser.add_argument("--height",
+		type=int, default=512,
+	)
+	parser.add_argument("--width",
+		type=int, default=512,
+	)
+	parser.add_argument("--runs",
+		help="number of runs per measurement",
+		type=int, default=3,
+	)
+	parser.add_argument("--threads",
+		help="torch threads (defaults to torch's)",
+		type=int, default=None,
+	)
+	args = parser.parse_args()
+
+	if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+		print("SDPA is not supported by this PyTorch version.")
+		sys.exit(1)
+
+	device, old_time, old_peak, old_out = run(args, False)
+	_, new_time, new_peak, new_out = run(args, True)
+
+	unit = "allocated" if device == "cuda" else "RSS growth"
+	print(f"device: {device}")
+	print(f"{args.backbone}, {args.width}x{args.height}")
+	if old_peak is not None:
+		print(f"\texplicit: {old_time * 1000 :.1f}ms, peak {old_peak :.1f}MiB ({unit})")
+		print(f"\tSDPA:     {new_time * 1000 :.1f}ms, peak {new_peak :.1f}MiB ({unit})")
+		print(f"\t-> x{old_time / new_time :.3f} faster, {old_peak - new_peak :.1f}MiB less")
+	else:
+		print(f"\texplicit: {old_time * 1000 :.1f}ms")
+		print(f"\tSDPA:     {new_time * 1000 :.1f}ms")
+		print(f"\t-> x{old_time / new_time :.3f} faster (the peak memory is not available on this platform)")
+	print(f"\tmax. abs. diff of the outputs: {(old_out - new_out).abs().max().item()} (output range {old_out.min().item() :.3f}..{old_out.max().item() :.3f})")
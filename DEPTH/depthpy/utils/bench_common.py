@@ -0,0 +1,58 @@
+import sys
+import time
+
+import numpy as np
+import torch
+
+try:
+	import resource #POSIX only
+except ImportError:
+	resource = None
+
+sys.path.append("..")
+from midas.dpt_depth import DPTDepthModel
+import midas.backbones.beit as beit
+import midas.backbones.vit as vit
+
+"""
+Shared by the benchmarks & checks of the backbones (`bench_beit_rel_pos.py`, `bench_beit_sdpa.py`, `check_vit_pos_embed.py`).
+The models are built with random weights, which do not affect the speed or whether the outputs match.
+"""
+
+def get_device():
+	return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def make_model(backbone, device):
+	return DPTDepthModel(path=None, backbone=backbone, non_negative=True).eval().to(device)
+
+def set_rel_pos_bias_cache(model, mib):
+	#BEiT: sets `beit.REL_POS_BIAS_CACHE_MIB` and empties the cache of `model`
+	beit.set_rel_pos_bias_cache(mib)
+	model.pretrained.model.blocks[0].attn.relative_position_biases.clear() #shared by the blocks
+
+def set_pos_embed_cache(model, size):
+	#ViT: sets `vit.POS_EMBED_CACHE_SIZE` and empties the cache of `model`
+	vit.POS_EMBED_CACHE_SIZE = size
+	model.pretrained.model.resized_pos_embeds.clear()
+
+def measure(model, x, runs):
+	#Returns the median time of `runs` forwards and the output (of the warm-up)
+	with torch.no_grad():
+		out = model(x) #warm up (& fill the caches)
+
+		times = []
+		for _ in range(runs):
+			start = time.perf_counter()
+			model(x)
+			if x.device.type == "cuda":
+				torch.cuda.synchronize()
+			times.append(time.perf_counter() - start)
+
+	return np.median(times), out
+
+def get_max_rss():
+	#The peak resident set size of this process in MiB, or `None` if it is not available (not on POSIX)
+	if resource is None:
+		return None
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return maxrss / 1024**2 if sys.platform == "darwin" else maxrss / 1024 #bytes on macOS, KiB elsewhere
@@ -0,0 +1,88 @@
+import sys
+import time
+import argparse
+import tracemalloc
+import zlib
+
+import numpy as np
+import cv2
+
+sys.path.append("..")
+from depth import Runner
+
+"""
+Micro-benchmark of the per-frame frame file encoding: the old PGM path (`normalize()`, `as_uint8()` & bytes concatenation)
+against `Runner.get_pgm()`.
+Then compares the frame formats by their encoding + deflate (level 5, as in the depthfile) time & size.
+"""
+
+class BenchRunner(Runner):
+	def framework_init(self):
+		pass
+
+def old_get_pgm(runner, image):
+	image = runner.normalize(image)
+	image *= 255
+	image = image.astype(np.uint8)
+
+	height, width = image.shape[:2]
+	return b"P5\n" + "{} {} {}\n".format(width, height, 255).encode("ascii") + image.tobytes()
+
+def measure(func, image, runs):
+	func(image) #warm up
+
+	times = []
+	for _ in range(runs):
+		start = time.perf_counter()
+		func(image)
+		times.append(time.perf_counter() - start)
+
+	tracemalloc.start()
+	func(image)
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	return np.median(times), peak
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--runs",
+		help="number of runs per measurement",
+		type=int, default=100,
+	)
+	args = parser.parse_args()
+
+	runner = BenchRunner()
+	rng = np.random.default_rng(0)
+
+	#Output sizes of the depth maps
+	shapes = {
+		"384x384": (384, 384),
+		"512x896": (512, 896),
+		"1080p": (1080, 1920),
+	}
+
+	for name, shape in shapes.items():
+		image = rng.random(shape, dtype=np.float32) * 100 #unnormalized, as from the model
+
+		funcs = {
+			"old": lambda x: old_get_pgm(runner, x),
+			"get_pgm": lambda x: runner.get_pgm(x),
+		}
+		buffer = runner.get_pgm(image)
+		funcs["get_pgm (reused)"] = lambda x: runner.get_pgm(x, out=buffer)
+
+		print(f"{name}:")
+		for funcname, func in funcs.items():
+			t, peak = measure(func, image, args.runs)
+			print(f"\t{funcname :<16}: {t * 1000 :.3f}ms, peak {peak / 1024 :.1f}KiB")
+
+		#Smooth, like a real depth map
+		depth = cv2.GaussianBlur(image, (0, 0), sigmaX=shape[1] / 32)
+
+		print(f"\t(encode + deflate)")
+		for frameformat in ["pgm", "pgm16", "pfm"]:
+			func = lambda x: zlib.compress(runner.get_framefile(x, frameformat), 5)
+			t, _ = measure(func, depth, max(args.runs // 10, 1))
+			size = len(func(depth))
+			print(f"\t{frameformat :<16}: {t * 1000 :.3f}ms, {size / 1024 :.1f}KiB")
@@ -0,0 +1,105 @@
+import sys
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+import cv2
+from torchvision.transforms import Compose, ToTensor
+
+sys.path.append("..")
+from midas.transforms import Resize, ToFloatImage, NormalizeImage, PrepareForNet
+
+"""
+Compares the old float64 input path (`cv2.cvtColor() / 255.0` before the transform)
+with the float32 one (the uint8 frame converted by `ToFloatImage` before the cubic resize) per frame, for 1080p and 4K inputs.
+Memory is the peak traced by `tracemalloc` (NumPy reports its allocations to it).
+"""
+
+def get_transforms(net_w, net_h, keep_aspect_ratio, ensure_multiple_of, resize_method, mean, std):
+	def resize():
+		return Resize(
+			net_w,
+			net_h,
+			resize_target=None,
+			keep_aspect_ratio=keep_aspect_ratio,
+			ensure_multiple_of=ensure_multiple_of,
+			resize_method=resize_method,
+			image_interpolation_method=cv2.INTER_CUBIC,
+		)
+
+	old = Compose([resize(), NormalizeImage(mean=mean, std=std), PrepareForNet()])
+	new = Compose([ToFloatImage(), resize(), NormalizeImage(mean=mean, std=std), PrepareForNet()])
+	return old, new
+
+#Same as the `load_model()`s of each runner
+midas_mean, midas_std = [0.5, 0.5, 0.5], [0.5, 0.5, 0.5]
+imagenet_mean, imagenet_std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+configs = {
+	"pt (dpt_hybrid_384)": get_transforms(384, 384, True, 32, "minimal", midas_mean, midas_std),
+	"ort (dpt_*_384)": get_transforms(384, 384, False, 32, "minimal", midas_mean, midas_std),
+	"dany": get_transforms(518, 518, True, 14, "lower_bound", imagenet_mean, imagenet_std),
+	"danyort": get_transforms(518, 518, False, 14, "lower_bound", imagenet_mean, imagenet_std),
+}
+
+def old_as_input(img):
+	return cv2.cvtColor(img, cv2.COLOR_BGR2RGB) / 255.0
+
+def new_as_input(img):
+	return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+def measure(func, frame, runs):
+	func(frame) #warm up
+
+	times = []
+	for _ in range(runs):
+		start = time.perf_counter()
+		func(frame)
+		times.append(time.perf_counter() - start)
+
+	tracemalloc.start()
+	func(frame)
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	return np.median(times), peak
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--runs",
+		help="number of runs per measurement",
+		type=int, default=20,
+	)
+	args = parser.parse_args()
+
+	rng = np.random.default_rng(0)
+	resolutions = {
+		"1080p": (1080, 1920),
+		"4K": (2160, 3840),
+	}
+
+	for resname, (h, w) in resolutions.items():
+		frame = rng.integers(0, 256, (h, w, 3), dtype=np.uint8) #BGR frame, as from cv2
+
+		funcs = {}
+		for name, (old, new) in configs.items():
+			funcs[name] = (
+				lambda f, old=old: old({"image": old_as_input(f)})["image"],
+				lambda f, new=new: new({"image": new_as_input(f)})["image"],
+			)
+		#ZoeRunner feeds the frame to ToTensor()
+		funcs["zoe"] = (
+			lambda f: ToTensor()(old_as_input(f).astype(np.float32)),
+			lambda f: ToTensor()(new_as_input(f)),
+		)
+
+		print(f"{resname} ({w}x{h}):")
+		for name, (old, new) in funcs.items():
+			old_time, old_peak = measure(old, frame, args.runs)
+			new_time, new_peak = measure(new, frame, args.runs)
+
+			print(f"\t{name}:")
+			print(f"\t\tfloat64: {old_time * 1000 :.2f}ms, peak {old_peak / 1024**2 :.2f}MiB")
+			print(f"\t\tfloat32: {new_time * 1000 :.2f}ms, peak {new_peak / 1024**2 :.2f}MiB")
+			print(f"\t\t-> x{old_time / new_time :.2f} faster, {(old_peak - new_peak) / 1024**2 :.2f}MiB less, max. abs. diff {np.abs(np.asarray(old(frame)) - np.asarray(new(frame))).max() :.2e}")
@@ -0,0 +1,89 @@
+import argparse
+
+import torch
+
+from bench_common import get_device, make_model, set_pos_embed_cache, measure
+import midas.backbones.vit as vit
+
+"""
+Checks that the cached resized position embeddings of the ViT backbones (`midas.backbones.vit.POS_EMBED_CACHE_SIZE`)
+are identical to the uncached ones, for several grid sizes and after the embedding is modified or converted,
+and compares the frames/s of the models with & without the cache.
+"""
+
+backbones = {
+	"dpt_large_384": "vitl16_384",
+	"dpt_hybrid_384": "vitb_rn50_384",
+}
+
+def check_pos_embed(model, sizes):
+	m = model.pretrained.model
+
+	with torch.no_grad():
+		for h, w in sizes:
+			gs_h, gs_w = h // m.patch_size[1], w // m.patch_size[0]
+
+			expected = vit._compute_resized_pos_embed(m, m.pos_embed, gs_h, gs_w)
+			for _ in range(2): #miss, then hit
+				resized = m._resize_pos_embed(m.pos_embed, gs_h, gs_w)
+				assert torch.equal(resized, expected), f"{h}x{w}: mismatch"
+
+		#In-place modification (as `load_state_dict()` does)
+		gs_h, gs_w = sizes[0][0] // m.patch_size[1], sizes[0][1] // m.patch_size[0]
+		m.pos_embed.mul_(2)
+		expected = vit._compute_resized_pos_embed(m, m.pos_embed, gs_h, gs_w)
+		assert torch.equal(m._resize_pos_embed(m.pos_embed, gs_h, gs_w), expected), "stale after an in-place modification"
+		m.pos_embed.div_(2)
+
+		#dtype change
+		posemb = m.pos_embed.double()
+		resized = m._resize_pos_embed(posemb, gs_h, gs_w)
+		assert resized.dtype == torch.float64, "stale after a dtype change"
+		assert torch.equal(resized, vit._compute_resized_pos_embed(m, posemb, gs_h, gs_w)), "mismatch after a dtype change"
+
+	assert len(m.resized_pos_embeds) <= vit.POS_EMBED_CACHE_SIZE
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--models",
+		help="models to check",
+		nargs="+", default=list(backbones), choices=list(backbones),
+	)
+	parser.add_argument("--runs",
+		help="number of runs per measurement, 0 to skip",
+		type=int, default=3,
+	)
+	args = parser.parse_args()
+
+	device = get_device()
+	print(f"device: {device}")
+
+	sizes = [(384, 384), (384, 512), (384, 672), (512, 384), (384, 512)]
+	default_size = vit.POS_EMBED_CACHE_SIZE
+
+	for name in args.models:
+		model = make_model(backbones[name], device)
+		print(f"{name}:")
+
+		check_pos_embed(model, sizes)
+		print(f"\tposition embeddings: identical for {len(set(sizes))} grid sizes")
+
+		x = torch.randn(1, 3, 384, 512, device=device)
+		with torch.no_grad():
+			set_pos_embed_cache(model, 0)
+			old_out = model(x)
+			set_pos_embed_cache(model, default_size)
+			model(x)
+			new_out = model(x) #cached
+		assert torch.equal(old_out, new_out), "outputs differ"
+		print(f"\toutputs: identical")
+
+		if args.runs > 0:
+			set_pos_embed_cache(model, 0)
+			old_time, _ = measure(model, x, args.runs)
+			set_pos_embed_cache(model, default_size)
+			new_time, _ = measure(model, x, args.runs)
+
+			print(f"\tuncached: {old_time * 1000 :.1f}ms")
+			print(f"\tcached:   {new_time * 1000 :.1f}ms")
+			print(f"\t-> x{old_time / new_time :.3f}")
@@ -1,19 +1,29 @@
+import sys
 import zipfile
 import argparse
 
 import cv2
 import numpy as np
 
+sys.path.append("..")
+from depthfile import DeltaDecoder, RawDepthReader
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 
 	parser.add_argument("input",
-		help="input file",
+		help="input file: a depthfile, or a raw depth file (`--container raw`)",
 	)
 	parser.add_argument("output",
 		help="output file",
 	)
 
+	parser.add_argument("--frameformat",
+		help="`pgm`, `pgm16`, `pgmdelta` or `pgm16delta`. Detected from the first frame if not given.",
+		default=None,
+		choices=["pgm", "pgm16", "pgmdelta", "pgm16delta"],
+	)
+
 	parser.add_argument("--fps",
 		help="FPS value that will override the value on the metadata",
 		default=None	     
@@ -30,48 +40,86 @@ if __name__ == "__main__":
 	filename = args.input
 	fps = args.fps
 
-	depthfile = zipfile.ZipFile(filename, "r")
+	#The raw file is read through memmap, without parsing each frame
+	raw = None
+	if not zipfile.is_zipfile(filename):
+		raw = RawDepthReader(filename)
+		print(f"Raw: {raw.framecount} frames of {raw.width}x{raw.height}, {raw.dtype}")
+	else:
+		depthfile = zipfile.ZipFile(filename, "r")
+		existing_filelist = depthfile.namelist()
+
+	metadata = None
+	if raw is not None:
+		metadata = raw.metadata
+	elif "METADATA.txt" in existing_filelist:
+		with depthfile.open("METADATA.txt", "r") as fin:
+			metadata = fin.read().decode("utf-8")
+
+	#The frame range (`--start` & `--stride` of depth.py)
+	range_start, range_stride = 0, 1
+	if metadata:
+		print("Found the metadata...")
+		metadata = dict(line.split('=', maxsplit=1) for line in metadata.split() if '=' in line)
+
+		range_start = int(metadata.get("range_start", 0))
+		range_stride = int(metadata.get("range_stride", 1))
+		if args.fps is None and "original_framerate" in metadata:
+			fps = float(metadata["original_framerate"]) / range_stride
 
-	existing_filelist = depthfile.namelist()
+	print(f"fps: {fps}")
 
-	if args.fps is None:
-		has_metadata = "METADATA.txt" in existing_filelist
-		if has_metadata:
-			print("Found the metadata...")
-			with depthfile.open("METADATA.txt", "r") as fin:
-				metadata = fin.read()
-				metadata = metadata.decode("utf-8")
-				metadata = [line for line in metadata.split() if line.startswith("original_framerate")]
+	if raw is None:
+		frameformat = args.frameformat
+		if frameformat is None:
+			frameformat = "pgm"
+			for candidate in ["pgm16", "pgmdelta", "pgm16delta"]:
+				if f"{range_start}.{candidate}" in existing_filelist:
+					frameformat = candidate
+		print(f"frameformat: {frameformat}")
 
-				if metadata != []:
-					fps = metadata[0].split('=')[-1]
-					fps = float(fps)
-
-	print(f"fps: {fps}")
+		delta_decoder = DeltaDecoder(depthfile, frameformat) if frameformat.endswith("delta") else None
 
 	#Video
 	vout = None
 	fourcc = cv2.VideoWriter_fourcc(*args.fourcc)
 
-	i = 0
+	i = 0 if raw is not None else range_start
 	while True:
-		pgmname = f"{i}.pgm"
-		if pgmname not in existing_filelist:
+		if raw is not None:
+			if i >= raw.framecount:
+				break
+			print(f"On #{raw.start + i * raw.stride}")
+			img = raw.frames[i]
+			if img.dtype.kind == 'f':
+				img = cv2.normalize(img.astype(np.float32), None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U) #Not normalized
+		elif f"{i}.{frameformat}" not in existing_filelist:
 			break
-		print(f"On {pgmname}")
-
-		with depthfile.open(pgmname, "r") as fin:
-			pgm = fin.read()
-
-		img = np.fromstring(pgm, np.uint8)
-		img = cv2.imdecode(img, cv2.IMREAD_COLOR)
+		elif delta_decoder is not None:
+			print(f"On {i}.{frameformat}")
+			img = delta_decoder.read(i)
+		else:
+			pgmname = f"{i}.{frameformat}"
+			print(f"On {pgmname}")
+			with depthfile.open(pgmname, "r") as fin:
+				pgm = fin.read()
+
+			img = np.frombuffer(pgm, np.uint8)
+			img = cv2.imdecode(img, cv2.IMREAD_UNCHANGED)
+		if img.dtype == np.uint16:
+			img = (img >> 8).astype(np.uint8) #The video is 8-bit
+		img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
 
 		if vout is None:
 			vout = cv2.VideoWriter(args.output, fourcc, fps, img.shape[:2][::-1])
 			print(img.shape[:2][::-1])
 		vout.write(img)
 
-		i += 1
+		i += 1 if raw is not None else range_stride
+
+	if vout is None:
+		print(f"No frames found (from #{range_start})")
+		sys.exit(1)
 
 	vout.release()
 	print("Done.")
\ No newline at end of file
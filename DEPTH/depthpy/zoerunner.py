@@ -30,8 +30,9 @@ class ZoeRunner(Runner):
 		print(f"Resize all outputs w/ `max_height`={self.height}")
 
 	def run_frame(self, img):
-		img = img.astype(np.float32)
-		img = ToTensor()(img).unsqueeze(0).to(self.device) #np.ndarray -> torch.Tensor
+		if img.dtype != np.uint8:
+			img = img.astype(np.float32)
+		img = ToTensor()(img).unsqueeze(0).to(self.device) #np.ndarray -> torch.Tensor (uint8 is scaled to [0, 1])
 		depth = self.model.infer(img) #Infer
 		depth = depth.detach().squeeze().cpu().numpy() #torch.Tensor -> np.ndarray
 